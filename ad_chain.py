@@ -1,13 +1,33 @@
 import json
-from dotenv import load_dotenv
-import streamlit as st
+import asyncio
+import contextvars
+import copy
+import hashlib
+import heapq
+import itertools
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import CancelledError, Future
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
 
-from langchain_core.prompts import ChatPromptTemplate, FewShotChatMessagePromptTemplate
-# from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.messages import SystemMessage
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 from langchain_core.output_parsers import JsonOutputParser
-from pydantic import BaseModel, Field
+from langchain_core.exceptions import OutputParserException
+from pydantic import BaseModel, Field, ValidationError
+
+from example_selector import RelevantExampleSelector, estimate_tokens
+from tracing import current_trace, span, trace, timed_iter
 
 
 # Pydantic model definition
@@ -22,12 +42,112 @@ class SocialMediaAd(BaseModel):
     email: str= Field(description="Email of the company/brand publishing the ad")
     website: str= Field(description="Website of the company/brand publishing the ad")
 
+class SocialMediaAdVariants(BaseModel):
+    ads: list[SocialMediaAd] = Field(description="Distinct ad options for the same specifications")
+
 # # Load API Key
 # def load_api_key():
 #     load_dotenv()       # Load api from .env
 #     if not os.environ.get("GOOGLE_API_KEY"):
 #         os.environ["GOOGLE_API_KEY"] = getpass.getpass("Enter API key for Google Gemini: ")
 
+MODEL_NAME = "gemini-2.0-flash"
+
+# Few-shot examples per request: the FEW_SHOT_K most relevant ones that fit in
+# FEW_SHOT_TOKEN_BUDGET (estimated) tokens. None for either means no limit.
+FEW_SHOT_K = 2
+FEW_SHOT_TOKEN_BUDGET = 800
+
+# Output rules from the system prompt, checked on every generated ad. The body text
+# passes between these fractions of the word limit: short bodies still lay out
+# fine, so only ones far off the limit are sent for repair.
+HEADLINE_MAX_CHARS = 25
+MAX_HASHTAGS = 3
+WORD_LIMIT_RANGE = (0.35, 1.2)
+# Repair calls per ad before the best attempt is returned as is
+REPAIR_ROUNDS = 2
+
+SYSTEM_PROMPT = (
+    "You are a highly creative and engaging social media ad generator. "
+    "Your output MUST be in JSON format. "
+    "Also use relevant emojis wherever needed. "
+    "Pay close attention to all provided specifications. Do not change any important information given. "
+    "Use proper punctuations. "
+    "If any field is empty, do not guess and leave the corresponding output field empty or skip non-essential text related to it. "
+    "You can correct the punctuations and spellings of the user input."
+    "The hashtags if generated should be exciting and appeal to the viewers. Generate maximum 3 hashtags."
+    "Limit the headline to a maximum of 25 characters, including spaces and punctuation."
+    "Use the given keywords to include."
+    "Ensure the main body text is as close as possible to the given word limit."
+    "Do not include call to action in main text body."
+    "There are few examples that you can consider before generating the output. "
+)
+
+AD_SPEC_TEMPLATE = (
+    "Generate a catchy ad based on the provided specifications:\n"
+    "- Name of company/brand: {company_name}\n"
+    "- Product name: {product_name}\n"
+    "- Product description: {product_description}\n"
+    "- Platform for the ad: {platform}\n"
+    "- Target audience: {audience}\n"
+    "- Tone of the ad: {tone}\n"
+    "- Call to action of the ad: {cta}\n"
+    "- Phone number of company for contact: {phone}\n"
+    "- Email of company for contact: {email}\n"
+    "- Website link of company: {website}\n"
+    "- Location: {location}\n"
+    "- Campaign Goal: {campaign_goal}\n"
+    "- Keywords to Include: {keywords_to_include}\n"
+    "- Word Limit of text: {word_limit} words\n"
+    "- Include hashtags: {include_hashtags}\n\n"
+)
+
+AD_KEYS_TEMPLATE = (
+    "- `company_name`: A catchy headline for the ad.\n"
+    "- `headline`: A catchy headline for the ad.\n"
+    "- `text`: The main body text of the ad.\n"
+    "- `call_to_action`: The call to action phrase.\n"
+    "- `hashtags`: An array of hashtags to be used.\n"
+    "- `location`: Location of the company.\n"
+    "- `phone`: Phone number of the company.\n"
+    "- `email`: Email of the company.\n"
+    "- `website`: Website of the company.\n"
+)
+
+HUMAN_TEMPLATE = (
+    AD_SPEC_TEMPLATE +
+    "The output should be a JSON object with the following keys:\n" +
+    AD_KEYS_TEMPLATE +
+    "{format_instructions}"
+)
+
+# Several ads in one call: the prompt (system + few-shots) is paid once for all of them
+HUMAN_VARIANTS_TEMPLATE = (
+    AD_SPEC_TEMPLATE +
+    "The output should be {n_variants} clearly different ad options, as a JSON object with an `ads` array "
+    "of {n_variants} JSON objects, each with the following keys:\n" +
+    AD_KEYS_TEMPLATE +
+    "{format_instructions}"
+)
+
+# Repair prompts: they carry only the broken output (or the failing fields) and the
+# specifications those fields need, not the system prompt and few-shot examples
+FIELD_REPAIR_TEMPLATE = (
+    "This social media ad for {product_name} ({product_description}) breaks some of its rules.\n"
+    "Tone: {tone}. Keywords to include: {keywords_to_include}.\n\n"
+    "Ad:\n{ad_json}\n\n"
+    "Rewrite only these fields:\n{problems}\n\n"
+    "Keep the language, tone, emojis and facts of the ad. "
+    "Output only a JSON object with exactly these keys: {keys}."
+)
+
+JSON_REPAIR_TEMPLATE = (
+    "The text below was meant to be a JSON object with the keys {keys}, but it is not valid JSON.\n"
+    "Output only the corrected JSON object, keeping every value as written.\n\n"
+    "{text}"
+)
+
+
 # Load examples (few shots)
 def load_few_shot_examples(file_path="examples.json"):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -35,129 +155,898 @@ def load_few_shot_examples(file_path="examples.json"):
     return examples
 
 
-# Initialize LLM and Chain
-def setup_llm_chain(temp=0.7):   
-    
-    examples = load_few_shot_examples()
-    parser = JsonOutputParser(pydantic_object=SocialMediaAd)
-    
-    llm_settings = { "temperature": temp, "max_output_tokens": 512, "top_k": 40,  "top_p": 0.95 }
-    
-    model = ChatGoogleGenerativeAI (
-      model="gemini-2.0-flash",
-      temperature=llm_settings["temperature"],
-      max_output_tokens=llm_settings["max_output_tokens"]
-    )
+# Everything below is built once per process and shared by all requests/sessions
+
+@lru_cache(maxsize=None)
+def get_parser(variants=False):
+    return JsonOutputParser(pydantic_object=SocialMediaAdVariants if variants else SocialMediaAd)
+
+
+# Each example is rendered to its (human, ai) message pair once; a request only
+# selects which pairs go into the prompt
+@lru_cache(maxsize=None)
+def get_few_shot():
 
     # Template for each example
     example_formatter_template = ChatPromptTemplate.from_messages(
         [
-            ("human",
-            "Generate a catchy ad based on the provided specifications:\n"
-            "- Name of company/brand: {company_name} \n"
-            "- Product name: {product_name}\n"
-            "- Product description: {product_description}\n"
-            "- Platform for the ad: {platform}\n"
-            "- Target audience: {audience}\n"
-            "- Tone of the ad: {tone}\n"
-            "- Call to action of the ad: {cta}\n"
-            "- Phone number of company for contact: {phone}\n"
-            "- Email of company for contact: {email}\n"
-            "- Website link of company: {website}\n"
-            "- Location: {location}\n"
-            "- Campaign Goal: {campaign_goal}\n"
-            "- Keywords to Include: {keywords_to_include}\n"
-            "- Word Limit of text: {word_limit} words\n"
-            "- Include hashtags: {include_hashtags}\n\n"),
-            
+            ("human", AD_SPEC_TEMPLATE),
             ("ai", "{ad_output_json}"),
         ]
     )
 
-    # Plug in few shot examples
-    few_shot_prompt = FewShotChatMessagePromptTemplate(
-        example_prompt=example_formatter_template,
-        examples=examples,
+    examples = load_few_shot_examples()
+    rendered = {id(example): example_formatter_template.format_messages(**example) for example in examples}
+    selector = RelevantExampleSelector(
+        examples, k=FEW_SHOT_K, token_budget=FEW_SHOT_TOKEN_BUDGET,
+        cost=lambda example: estimate_tokens("".join(m.content for m in rendered[id(example)])),
     )
+    return selector, rendered
+
+def select_example_messages(input_data):
+    selector, rendered = get_few_shot()
+    return [message for example in selector.select_examples(input_data) for message in rendered[id(example)]]
 
-    # Main chat prompt template
 
+# The system message is static; selected examples are plugged in per request and
+# only the final human message is formatted
+@lru_cache(maxsize=None)
+def get_prompt(variants=False):
+
+    # Main chat prompt template
     chat_prompt = ChatPromptTemplate.from_messages([
-        
-        
-        ("system", "You are a highly creative and engaging social media ad generator. "
-                "Your output MUST be in JSON format. "
-                "Also use relevant emojis wherever needed. "
-                "Pay close attention to all provided specifications. Do not change any important information given. "
-                "Use proper punctuations. "
-                "If any field is empty, do not guess and leave the corresponding output field empty or skip non-essential text related to it. "
-                "You can correct the punctuations and spellings of the user input."
-                "The hashtags if generated should be exciting and appeal to the viewers. Generate maximum 3 hashtags."
-                "Limit the headline to a maximum of 25 characters, including spaces and punctuation."
-                "Use the given keywords to include."
-                "Ensure the main body text is as close as possible to the given word limit."
-                "Do not include call to action in main text body."
-                "There are few examples that you can consider before generating the output. "),
-
-        
-        few_shot_prompt,
-        
-        
-        ("human", 
-        "Generate a catchy ad based on the provided specifications:\n"
-        "- Name of company/brand: {company_name}\n"
-        "- Product name: {product_name}\n"
-        "- Product description: {product_description}\n"
-        "- Platform for the ad: {platform}\n"
-        "- Target audience: {audience}\n"
-        "- Tone of the ad: {tone}\n"
-        "- Call to action of the ad: {cta}\n"
-        "- Phone number of company for contact: {phone}\n"
-        "- Email of company for contact: {email}\n"
-        "- Website link of company: {website}\n"
-        "- Location: {location}\n"
-        "- Campaign Goal: {campaign_goal}\n"
-        "- Keywords to Include: {keywords_to_include}\n"
-        "- Word Limit of text: {word_limit} words\n"
-        "- Include hashtags: {include_hashtags}\n\n"
-
-        "The output should be a JSON object with the following keys:\n"
-        # "The output should be 2 JSON object options with the following keys: \n"
-        "- `company_name`: A catchy headline for the ad.\n"
-        "- `headline`: A catchy headline for the ad.\n"
-        "- `text`: The main body text of the ad.\n"
-        "- `call_to_action`: The call to action phrase.\n"
-        "- `hashtags`: An array of hashtags to be used.\n"
-        "- `location`: Location of the company.\n"
-        "- `phone`: Phone number of the company.\n"
-        "- `email`: Email of the company.\n"
-        "- `website`: Website of the company.\n"
-
-        "{format_instructions}"
-        ),
+        SystemMessage(SYSTEM_PROMPT),
+        MessagesPlaceholder("examples"),
+        ("human", HUMAN_VARIANTS_TEMPLATE if variants else HUMAN_TEMPLATE),
     ])
+    return chat_prompt.partial(format_instructions=get_parser(variants).get_format_instructions())
+
+
+# One model (and so one HTTP client) per process. Needs GOOGLE_API_KEY, so it is
+# created on first use rather than at import.
+@lru_cache(maxsize=None)
+def get_model():
+    return ChatGoogleGenerativeAI(
+        model=MODEL_NAME,
+        max_output_tokens=512,
+    )
+
+
+# Chain step in front of the model: charges each call (prompt estimate plus its
+# output token limit) to the shared scheduler's buckets before it is sent
+def quota_gate(max_output_tokens=512):
+    def tokens(prompt_value):
+        return estimate_tokens(prompt_value.to_string()) + max_output_tokens
+
+    def charge(prompt_value):
+        get_scheduler().charge(tokens(prompt_value))
+        return prompt_value
+
+    async def acharge(prompt_value):
+        await get_scheduler().acharge(tokens(prompt_value))
+        return prompt_value
+
+    return RunnableLambda(charge, afunc=acharge, name="quota_gate")
+
+
+# Initialize LLM and Chain. Temperature is bound per call on the shared model
+# instead of constructing a new client for every value.
+@lru_cache(maxsize=64)
+def setup_llm_chain(temp=0.7):
+    return (
+        RunnablePassthrough.assign(examples=select_example_messages)
+        | get_prompt()
+        | quota_gate()
+        | get_model().bind(temperature=temp)
+        | get_parser()
+    )
+
+# Chain returning {"ads": [...]} with n ads; the output token limit grows with n
+@lru_cache(maxsize=64)
+def setup_variants_chain(temp=0.7, n=3):
+    return (
+        RunnablePassthrough.assign(examples=select_example_messages, n_variants=lambda _: n)
+        | get_prompt(variants=True)
+        | quota_gate(512 * n)
+        | get_model().bind(temperature=temp, max_output_tokens=512 * n)
+        | get_parser(variants=True)
+    )
+
+# Repair chains are small and return a plain dict. Broken JSON is fixed at
+# temperature 0 since nothing should be rewritten.
+@lru_cache(maxsize=64)
+def setup_repair_chain(temp=0.7):
+    prompt = ChatPromptTemplate.from_messages([("human", FIELD_REPAIR_TEMPLATE)])
+    return prompt | quota_gate(256) | get_model().bind(temperature=temp, max_output_tokens=256) | JsonOutputParser()
+
+# The JSON repair echoes the whole output, so like setup_variants_chain its output
+# token limit grows with the number of ads n
+@lru_cache(maxsize=None)
+def setup_json_repair_chain(n=1):
+    prompt = ChatPromptTemplate.from_messages([("human", JSON_REPAIR_TEMPLATE)])
+    return (prompt | quota_gate(512 * n) | get_model().bind(temperature=0, max_output_tokens=512 * n)
+            | JsonOutputParser())
+
+# Builds the shared objects (few-shot index, prompts, parsers, model client, chain)
+# ahead of the first request, e.g. from a background thread at app start-up
+def warm_up(temps=(0.7,)):
+    get_few_shot()
+    for variants in (False, True):
+        get_prompt(variants)
+    for temp in temps:
+        setup_llm_chain(temp)
+
+
+# Version of everything that shapes the model output besides the inputs: a prompt
+# or example change invalidates previously cached responses
+@lru_cache(maxsize=None)
+def prompt_version(file_path="examples.json"):
+    digest = hashlib.sha256()
+    for part in (SYSTEM_PROMPT, AD_SPEC_TEMPLATE, HUMAN_TEMPLATE, HUMAN_VARIANTS_TEMPLATE,
+                 FIELD_REPAIR_TEMPLATE, JSON_REPAIR_TEMPLATE, str(FEW_SHOT_K), str(FEW_SHOT_TOKEN_BUDGET),
+                 str((HEADLINE_MAX_CHARS, MAX_HASHTAGS, WORD_LIMIT_RANGE))):
+        digest.update(part.encode())
+    with open(file_path, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+# Whitespace differences shouldn't produce a different cache entry
+def normalize_inputs(input_data):
+    def normalize(value):
+        if isinstance(value, str):
+            return " ".join(value.split())
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        return "" if value is None else value
+    return {k: normalize(v) for k, v in sorted(input_data.items()) if k != "format_instructions"}
+
+def response_key(input_data, temp, model_name=MODEL_NAME):
+    payload = {
+        "inputs": normalize_inputs(input_data),
+        "model": model_name,
+        "temperature": round(float(temp), 3),
+        "prompt": prompt_version(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# On-disk cache of parsed LLM responses (SQLite), shared by all sessions and
+# processes on the machine. Entries expire after ttl seconds; beyond max_entries
+# the least recently used ones are evicted.
+class ResponseCache:
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=10000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM responses WHERE key = ? AND created >= ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+
+@lru_cache(maxsize=None)
+def get_response_cache():
+    cache_dir = os.environ.get("ADCRAFT_CACHE_DIR", ".cache")
+    return ResponseCache(os.path.join(cache_dir, "ad_responses.sqlite3"))
+
+
+# Client-side token bucket holding up to `burst` (default: one minute) of quota. Not
+# thread safe on its own: GeminiScheduler calls it under its lock. per_minute=None
+# means no limit. The level can go negative after a reserve(); later callers then
+# wait for the debt to be paid back.
+class TokenBucket:
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60 if per_minute else None
+        self.capacity = burst or per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until `amount` can be taken (a request larger than the bucket waits for a full one)
+    def delay(self, amount):
+        if self.rate is None:
+            return 0.0
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount):
+        if self.rate is not None:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+
+    # Takes `amount` now, possibly into debt, and returns the seconds to wait before
+    # using it; for callers that can't block in a queue (asyncio tasks)
+    def reserve(self, amount):
+        delay = self.delay(amount)
+        self.take(amount)
+        return delay
+
+
+# The current slot's priority and whether the quota charged on its admission has
+# been used by its first model call yet (see GeminiScheduler.slot). A dict, so the
+# copies of the context LangChain runs steps in share it.
+_prepaid = contextvars.ContextVar("adcraft_prepaid", default=None)
+
+def _use_prepaid():
+    current = _prepaid.get()
+    if current and current["paid"]:
+        current["paid"] = False
+        return True
+    return False
+
+# Process-wide gate in front of Gemini, shared by every Streamlit session (they all
+# use the same API key). Calls wait in a priority queue (lower number first, FIFO
+# within a priority) until a concurrency slot is free and the requests/minute and
+# tokens/minute buckets allow them, instead of all hitting the API at once and
+# getting 429s. Identical calls (same key) already in flight share one call.
+# Every model call is charged to the buckets (see quota_gate): the first one of a
+# slot when the slot is admitted, repair calls made inside it when they are sent.
+# None (or 0) for any limit means unlimited.
+class GeminiScheduler:
+
+    def __init__(self, rpm=None, tpm=None, max_concurrency=8):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self._cond = threading.Condition()
+        self._queue = []
+        self._quota_queue = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._inflight = {}
+        self._waits = deque(maxlen=1000)
+        self.admitted = 0
+        self.coalesced = 0
+        self.charged = 0
+
+    def _has_capacity(self):
+        return not self.max_concurrency or self._running < self.max_concurrency
+
+    # Next entry to admit: calls that only need quota (already running in a slot)
+    # compete with new slots by priority, but are never held up by a full house
+    def _next_entry(self):
+        candidates = self._quota_queue[:1] + (self._queue[:1] if self._has_capacity() else [])
+        return min(candidates) if candidates else None
+
+    # Waits (under self._cond) until entry is next and the buckets allow `tokens`,
+    # then charges them
+    def _admit(self, entry, queue, tokens):
+        heapq.heappush(queue, entry)
+        self._cond.notify_all()
+        try:
+            while True:
+                if self._next_entry() == entry:
+                    delay = max(self.requests.delay(1), self.tokens.delay(tokens))
+                    if delay <= 0:
+                        break
+                    # Woken early if a higher priority call arrives
+                    self._cond.wait(delay)
+                else:
+                    self._cond.wait()
+        except BaseException:
+            queue.remove(entry)
+            heapq.heapify(queue)
+            self._cond.notify_all()
+            raise
+        queue.remove(entry)
+        heapq.heapify(queue)
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.charged += 1
+        self._cond.notify_all()
+
+    # Blocks until the call may start and holds its concurrency slot until exit. The
+    # quota for the slot's first model call (`tokens`) is charged on admission.
+    @contextmanager
+    def slot(self, priority=0, tokens=1):
+        entry = (priority, next(self._seq))
+        enqueued = time.monotonic()
+        with span("queue_wait"), self._cond:
+            self._admit(entry, self._queue, tokens)
+            self._running += 1
+            self.admitted += 1
+            self._waits.append(time.monotonic() - enqueued)
+        previous, prepaid = _prepaid.get(), {"priority": priority, "paid": True}
+        _prepaid.set(prepaid)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+            # Not reset(token): a generator holding the slot (stream_ad) may be closed
+            # from another context, where the token is invalid and the value set
+            # above is left behind in the context that iterated it, used up
+            prepaid["paid"] = False
+            _prepaid.set(previous)
+
+    # Charges one model call of `tokens` to the buckets, waiting for them if needed.
+    # The first call in a slot was paid for on admission; later ones (repairs) queue
+    # at the slot's priority.
+    def charge(self, tokens):
+        if _use_prepaid():
+            return
+        current = _prepaid.get()
+        priority = current["priority"] if current else 0
+        with span("quota_wait"), self._cond:
+            self._admit((priority, next(self._seq)), self._quota_queue, tokens)
 
-    # print(chat_prompt)
-    
-    # Return full chain
-    return chat_prompt | model | parser
+    # charge() for asyncio tasks: the quota is reserved right away and the task
+    # sleeps until it is available, without blocking the event loop
+    async def acharge(self, tokens):
+        if _use_prepaid():
+            return
+        with self._cond:
+            delay = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+            self.charged += 1
+        if delay > 0:
+            await asyncio.sleep(delay)
 
-def generate_ad(input_data, temp):
+    # Async counterpart of slot() for the batch path (which limits concurrency
+    # itself): waits for the quota of the first model call made in the block
+    @asynccontextmanager
+    async def aprepay(self, tokens=1):
+        await self.acharge(tokens)
+        previous = _prepaid.get()
+        _prepaid.set({"priority": 0, "paid": True})
+        try:
+            yield
+        finally:
+            _prepaid.set(previous)
 
-    parser = JsonOutputParser(pydantic_object=SocialMediaAd)
-    
+    # Runs fn() in a slot, or if a call with the same key is already in flight,
+    # waits for it and returns (a copy of) its result
+    def run(self, key, fn, priority=0, tokens=1):
+        with self._cond:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            with span("coalesced_wait"):
+                return copy.deepcopy(future.result())
+        try:
+            with self.slot(priority, tokens):
+                result = fn()
+            future.set_result(result)
+            return copy.deepcopy(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._cond:
+                del self._inflight[key]
+
+    # run() for a generator: the first caller with a key iterates stream() in a slot
+    # and gets every item; callers with the same key meanwhile wait and get (a copy
+    # of) its last item once. If that stream is closed early, they run their own.
+    def run_stream(self, key, stream, priority=0, tokens=1):
+        while True:
+            with self._cond:
+                future = self._inflight.get(key)
+                owner = future is None
+                if owner:
+                    future = self._inflight[key] = Future()
+                else:
+                    self.coalesced += 1
+            if owner:
+                break
+            try:
+                with span("coalesced_wait"):
+                    result = future.result()
+            except CancelledError:
+                continue
+            if result is not None:
+                yield copy.deepcopy(result)
+            return
+        result = None
+        try:
+            with self.slot(priority, tokens):
+                for result in stream():
+                    yield result
+            future.set_result(result)
+        except GeneratorExit:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._cond:
+                del self._inflight[key]
+
+    def stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                "queue_depth": len(self._queue) + len(self._quota_queue),
+                "running": self._running,
+                "in_flight_keys": len(self._inflight),
+                "admitted": self.admitted,
+                "coalesced": self.coalesced,
+                "charged_calls": self.charged,
+                "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "wait_max": waits[-1] if waits else 0.0,
+            }
+
+
+# Limits default to the Gemini free tier for MODEL_NAME; set ADCRAFT_GEMINI_RPM /
+# ADCRAFT_GEMINI_TPM (0 for no limit) and ADCRAFT_GEMINI_CONCURRENCY to match the key's quota
+@lru_cache(maxsize=None)
+def get_scheduler():
+    return GeminiScheduler(
+        rpm=int(os.environ.get("ADCRAFT_GEMINI_RPM", 15)),
+        tpm=int(os.environ.get("ADCRAFT_GEMINI_TPM", 1_000_000)),
+        max_concurrency=int(os.environ.get("ADCRAFT_GEMINI_CONCURRENCY", 8)),
+    )
+
+# Estimated tokens/minute cost of one generation, without formatting the prompt:
+# its fixed text, the inputs, the few-shot budget (an upper bound on the selected
+# examples) and the output token limit. Repairs, when needed, are small next to this.
+@lru_cache(maxsize=None)
+def prompt_base_tokens(variants=False):
+    format_instructions = get_parser(variants).get_format_instructions()
+    return estimate_tokens(SYSTEM_PROMPT + (HUMAN_VARIANTS_TEMPLATE if variants else HUMAN_TEMPLATE)
+                           + format_instructions)
+
+def request_tokens(input_data, n=1):
+    inputs = "".join(str(value) for value in input_data.values())
+    return prompt_base_tokens(n > 1) + estimate_tokens(inputs) + (FEW_SHOT_TOKEN_BUDGET or 0) + 512 * n
+
+
+# Validation and repair
+
+def word_limit_of(input_data):
+    words = str(input_data.get("word_limit") or "").split()
+    return int(words[0]) if words and words[0].isdigit() else None
+
+def parse_flag(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+# Fixes that need no model call: contact fields the model dropped are copied from
+# the form, and extra or unwanted hashtags are cut. Returns a new dict.
+def fix_ad_locally(ad, input_data):
+    ad = dict(ad)
+    for field, source in (("company_name", "company_name"), ("call_to_action", "cta"), ("location", "location"),
+                          ("phone", "phone"), ("email", "email"), ("website", "website")):
+        if not isinstance(ad.get(field), str):
+            ad[field] = str(input_data.get(source) or "")
+    hashtags = ad.get("hashtags")
+    if isinstance(hashtags, str):
+        hashtags = hashtags.replace(",", " ").split()
+    if not isinstance(hashtags, list) or not parse_flag(input_data.get("include_hashtags", True)):
+        hashtags = []
+    ad["hashtags"] = [str(tag) for tag in hashtags][:MAX_HASHTAGS]
+    return ad
+
+# Rule violations left in an ad, as {field: what the field should be}
+def check_ad(ad, input_data):
+    problems = {}
+    headline = ad.get("headline")
+    if not isinstance(headline, str) or not headline.strip():
+        problems["headline"] = f"missing; write a catchy headline of at most {HEADLINE_MAX_CHARS} characters"
+    elif len(headline) > HEADLINE_MAX_CHARS:
+        problems["headline"] = (f"at most {HEADLINE_MAX_CHARS} characters including spaces, punctuation "
+                                f"and emojis (now {len(headline)})")
+    text = ad.get("text")
+    limit = word_limit_of(input_data)
+    if not isinstance(text, str) or not text.strip():
+        problems["text"] = f"missing; write the main body text of about {limit or 50} words"
+    elif limit:
+        words = len(text.split())
+        low, high = (round(limit * bound) for bound in WORD_LIMIT_RANGE)
+        if not low <= words <= high:
+            problems["text"] = (f"about {limit} words, between {low} and {high}, without the call to action "
+                                f"(now {words})")
+    hashtags = ad.get("hashtags")
+    if isinstance(hashtags, list) and len(hashtags) > MAX_HASHTAGS:
+        problems["hashtags"] = f"at most {MAX_HASHTAGS} hashtags (now {len(hashtags)})"
+    for field in SocialMediaAd.model_fields:
+        if field not in ad and field not in problems:
+            problems[field] = "missing"
+    return problems
+
+# Input of the field repair prompt for the violations left in an ad, or None
+def repair_request(ad, input_data):
+    problems = check_ad(ad, input_data)
+    if not problems:
+        return None, problems
+    context = {field: ad[field] for field in ("headline", "text", "call_to_action") if field in ad}
+    request = {
+        **{k: input_data.get(k) or "" for k in ("product_name", "product_description", "tone",
+                                                "keywords_to_include")},
+        "ad_json": json.dumps(context, ensure_ascii=False),
+        "problems": "\n".join(f"- {field}: {problem}" for field, problem in problems.items()),
+        "keys": ", ".join(problems),
+    }
+    return request, problems
+
+# Only the fields that were asked for are taken from the repair output
+def merge_repair(ad, fixed, problems, input_data):
+    if not isinstance(fixed, dict):
+        return ad
+    return fix_ad_locally({**ad, **{k: v for k, v in fixed.items() if k in problems}}, input_data)
+
+# Makes an ad follow the output rules. Whatever can be fixed locally is; remaining
+# violations (headline, body text) go to a small repair prompt asking for just
+# those fields, up to REPAIR_ROUNDS times. Returns the best ad obtained, also when a
+# repair call fails.
+def repair_ad(ad, input_data, temp=0.7):
+    ad = fix_ad_locally(ad, input_data)
+    for _ in range(REPAIR_ROUNDS):
+        request, problems = repair_request(ad, input_data)
+        if request is None:
+            break
+        try:
+            ad = merge_repair(ad, setup_repair_chain(temp).invoke(request), problems, input_data)
+        except OutputParserException:
+            continue
+        except Exception:
+            break  # e.g. a 429: the ad we have beats failing the whole generation
+    return ad
+
+async def arepair_ad(ad, input_data, temp=0.7):
+    ad = fix_ad_locally(ad, input_data)
+    for _ in range(REPAIR_ROUNDS):
+        request, problems = repair_request(ad, input_data)
+        if request is None:
+            break
+        try:
+            ad = merge_repair(ad, await setup_repair_chain(temp).ainvoke(request), problems, input_data)
+        except OutputParserException:
+            continue
+        except Exception:
+            break
+    return ad
+
+# Keeps the raw text of the model's output, for repairing it when a stream never
+# parsed (streaming parsers skip what they can't parse instead of raising)
+class LLMOutput(BaseCallbackHandler):
+
+    def __init__(self):
+        self.text = ""
+
+    def on_llm_end(self, response, **kwargs):
+        self.text = response.generations[0][0].text if response.generations and response.generations[0] else ""
+
+def json_repair_request(text, variants=False):
+    return {"text": text, "keys": "ads" if variants else ", ".join(SocialMediaAd.model_fields)}
+
+# Output the parser rejected: the raw text is sent back with a short request to fix
+# the JSON only, instead of generating the ad again. Raises if that fails too.
+def invoke_or_repair(chain, input_data, variants=False, n=1):
+    try:
+        return invoke_traced(chain, input_data)
+    except OutputParserException as e:
+        if not e.llm_output:
+            raise
+        with span("json_repair"):
+            return setup_json_repair_chain(n).invoke(json_repair_request(e.llm_output, variants))
+
+async def ainvoke_or_repair(chain, input_data, variants=False, n=1):
+    try:
+        return await chain.ainvoke(input_data)
+    except OutputParserException as e:
+        if not e.llm_output:
+            raise
+        return await setup_json_repair_chain(n).ainvoke(json_repair_request(e.llm_output, variants))
+
+
+# Spans for the steps of setup_llm_chain / setup_variants_chain
+CHAIN_STAGES = ("select_examples", "format_prompt", "quota", "gemini", "parse_json")
+
+# Adds a span for each step of a chain run (each direct child of the first run it
+# sees) to the trace active when it was created: stages[i] for the i-th step, the
+# step's own name past the end of stages
+class StageTimer(BaseCallbackHandler):
+
+    def __init__(self, stages=CHAIN_STAGES):
+        self.stages = stages
+        self.trace = current_trace()
+        self.root = None
+        self.steps = 0
+        self._started = {}
+
+    def _start(self, run_id, parent_run_id, name):
+        if self.root is None:
+            self.root = run_id
+        elif parent_run_id == self.root:
+            stage = self.stages[self.steps] if self.steps < len(self.stages) else name
+            self.steps += 1
+            self._started[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id):
+        started = self._started.pop(run_id, None)
+        if started is not None and self.trace is not None:
+            stage, start = started
+            self.trace.add(stage, time.perf_counter() - start)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name"))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name"))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name"))
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+# chain.invoke with each step timed as its own span. The timer rides along as a
+# callback, so the run keeps the caller's callbacks, tags and parent run.
+def invoke_traced(chain, input_data, stages=CHAIN_STAGES):
+    return chain.invoke(input_data, config={"callbacks": [StageTimer(stages)]})
+
+
+# Every response is stored; with replay=True a cached response for the same
+# (normalized) inputs, model, temperature and prompt version is served instead of
+# calling Gemini, so the same form always gives the same ad. Calls go through the
+# shared scheduler (lower priority number runs first).
+def generate_ad(input_data, temp, replay=False, cache=None, priority=0):
+
+    with trace("generate"):
+        cache = cache or get_response_cache()
+        key = response_key(input_data, temp)
+
+        if replay:
+            with span("response_cache"):
+                cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+        def generate():
+            chain = setup_llm_chain(temp)
+
+            # print("Input:")
+            # print(input_data)
+
+            result = invoke_or_repair(chain, input_data)
+            with span("field_repair"):
+                result = repair_ad(result, input_data, temp)
+
+            # print("Result:")
+            # print(result)
+
+            with span("response_cache"):
+                cache.put(key, result)
+            return result
+
+        with span("estimate_tokens"):
+            tokens = request_tokens(input_data)
+        return get_scheduler().run(key, generate, priority, tokens)
+
+
+# Keeps the ads that match the SocialMediaAd schema (the model occasionally drops a
+# field in one of the options), as plain dicts
+def validate_ads(result):
+    ads = result.get("ads", []) if isinstance(result, dict) else result
+    valid = []
+    for ad in ads or []:
+        try:
+            valid.append(SocialMediaAd.model_validate(ad).model_dump())
+        except ValidationError:
+            continue
+    return valid
+
+# n ad options from a single LLM call. Returns the list of valid ads (possibly fewer than n).
+def generate_ads(input_data, temp, n=3, replay=False, cache=None, priority=0):
+
+    with trace("generate_variants"):
+        cache = cache or get_response_cache()
+        key = response_key({**input_data, "n_variants": n}, temp)
+
+        if replay:
+            with span("response_cache"):
+                cached = cache.get(key)
+            if cached is not None:
+                return cached
+
+        def generate():
+            result = invoke_or_repair(setup_variants_chain(temp, n), input_data, variants=True, n=n)
+            ads = result.get("ads", []) if isinstance(result, dict) else result
+            with span("field_repair"):
+                ads = validate_ads([repair_ad(ad, input_data, temp) for ad in ads or [] if isinstance(ad, dict)])
+            if ads:
+                with span("response_cache"):
+                    cache.put(key, ads)
+            return ads
+
+        with span("estimate_tokens"):
+            tokens = request_tokens(input_data, n)
+        return get_scheduler().run(key, generate, priority, tokens)
+
+
+# Streaming version of generate_ad: yields the ad as a growing dict while Gemini is
+# still writing it (JsonOutputParser parses the partial JSON), ending with the
+# complete ad, repaired if it breaks the output rules (or its JSON, if it never
+# parsed; raises if that fails). Only the complete ad is cached. Identical streams in flight share one call: the later ones only get the complete ad.
+def stream_ad(input_data, temp, replay=False, cache=None, priority=0):
+
+    cache = cache or get_response_cache()
+    key = response_key(input_data, temp)
+
+    if replay:
+        with span("response_cache"):
+            cached = cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    def stream():
+        result, output = None, LLMOutput()
+        chunks = setup_llm_chain(temp).stream(input_data, config={"callbacks": [output]})
+        for result in timed_iter(chunks, "gemini_stream", "gemini_first_chunk"):
+            yield result
+        if not isinstance(result, dict):
+            # Nothing parsed: the raw output goes to the JSON repair, as in invoke_or_repair
+            if not output.text.strip():
+                raise OutputParserException("Gemini returned no ad")
+            with span("json_repair"):
+                result = setup_json_repair_chain().invoke(json_repair_request(output.text))
+            if not isinstance(result, dict):
+                raise OutputParserException(f"Not an ad: {result!r}", llm_output=output.text)
+            yield result
+        with span("field_repair"):
+            repaired = repair_ad(result, input_data, temp)
+        if repaired != result:
+            yield repaired
+        with span("response_cache"):
+            cache.put(key, repaired)
+
+    with span("estimate_tokens"):
+        tokens = request_tokens(input_data)
+    yield from get_scheduler().run_stream(key, stream, priority, tokens)
+
+
+# Outcome of one item of a batch: index into the inputs, the ad (None on failure),
+# the last error (None on success) and how many calls it took
+BatchResult = namedtuple("BatchResult", ["index", "ad", "error", "attempts"])
+
+# Generates ads for many inputs concurrently and yields BatchResults in completion
+# order, so a slow item never holds up the others. At most `concurrency` calls are in
+# flight, and every model call waits for the shared scheduler's requests/tokens per
+# minute quota. Each attempt (the generation plus any repair calls) gets `timeout`
+# seconds and up to `retries` retries with exponential backoff and jitter (the slot
+# is released while backing off).
+async def agenerate_ads_batch(inputs, temp=0.7, concurrency=8, timeout=60, retries=2,
+                              backoff=1.0, replay=False, cache=None):
+
+    cache = cache or get_response_cache()
     chain = setup_llm_chain(temp)
-    
-    input_data["format_instructions"] = parser.get_format_instructions()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Generation and any repair calls, under one timeout
+    async def generate_and_repair(input_data):
+        result = await ainvoke_or_repair(chain, input_data)
+        return await arepair_ad(result, input_data, temp)
+
+    async def run(index, input_data):
+        key = response_key(input_data, temp)
+        if replay:
+            cached = cache.get(key)
+            if cached is not None:
+                return BatchResult(index, cached, None, 0)
+        error = None
+        for attempt in range(1, retries + 2):
+            try:
+                async with semaphore, get_scheduler().aprepay(request_tokens(input_data)):
+                    result = await asyncio.wait_for(generate_and_repair(input_data), timeout)
+                cache.put(key, result)
+                return BatchResult(index, result, None, attempt)
+            except Exception as e:
+                error = e
+                if attempt <= retries:
+                    await asyncio.sleep(backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        return BatchResult(index, None, error, retries + 1)
+
+    tasks = [asyncio.ensure_future(run(i, input_data)) for i, input_data in enumerate(inputs)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Blocking version of agenerate_ads_batch for sync callers (scripts, Streamlit).
+# The event loop runs in a worker thread and results are still yielded as they finish.
+# Closing the generator early cancels the batch, so no more model calls are made.
+def generate_ads_batch(inputs, temp=0.7, concurrency=8, **kwargs):
+
+    results = queue.Queue()
+    done = object()
+    stop = threading.Event()
+    running = {}
 
-    # print("Input:")
-    # print(input_data)
-    
-    result = chain.invoke(input_data)
-    
-    # print("Result:")
-    # print(result)
-    
-    return result
+    async def consume():
+        running["loop"], running["task"] = asyncio.get_running_loop(), asyncio.current_task()
+        if stop.is_set():
+            return
+        async for result in agenerate_ads_batch(inputs, temp, concurrency, **kwargs):
+            results.put(result)
 
+    def worker():
+        try:
+            asyncio.run(consume())
+        except BaseException as e:
+            results.put(e)
+        finally:
+            results.put(done)
 
+    threading.Thread(target=worker, daemon=True).start()
+    try:
+        while (item := results.get()) is not done:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        if running:
+            try:
+                running["loop"].call_soon_threadsafe(running["task"].cancel)
+            except RuntimeError:
+                pass  # the loop has already finished
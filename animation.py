@@ -0,0 +1,207 @@
+import io
+import math
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+from PIL import GifImagePlugin, Image, ImageColor, ImageDraw
+
+from cache import LRUCache
+from image_gen import ad_hash, compute_layout, grad_ratio, image_nbytes
+from tracing import span
+
+
+# The middle block enters one section after the other; the company name and the
+# contact info are there from the first frame
+ANIMATED_SECTIONS = ("headline", "text", "call_to_action", "hashtags")
+
+EFFECTS = ("fade", "slide")
+
+# One laid-out section of an ad rasterized once as a coverage mask (text drawn in 255
+# on 0), with the position of its top-left corner in the full-size ad
+Sprite = namedtuple("Sprite", ["section", "position", "mask"])
+
+# Sprites depend only on the ad text, font and size, so recoloring or re-timing an
+# animation re-uses them. ~1 byte per pixel of each section's bounding box.
+sprite_cache = LRUCache(max_bytes=64 * 1024 * 1024, sizeof=lambda sprites: sum(image_nbytes(s.mask) for s in sprites))
+
+def text_sprites(ad, font_path, size=(1080, 1080), autofit=True):
+    size = tuple(size)
+    return sprite_cache.get_or_create((ad_hash(ad), font_path, size, autofit),
+                                      lambda: _text_sprites(ad, font_path, size, autofit))
+
+def _text_sprites(ad, font_path, size, autofit):
+    plan = compute_layout(ad, font_path, size, autofit=autofit)
+    sections = {}
+    for run in plan.runs:
+        sections.setdefault(run.section, []).append(run)
+    sprites = []
+    with span("sprites"):
+        for section, runs in sections.items():
+            boxes = [(run.x + left, run.y + top, run.x + right, run.y + bottom)
+                     for run in runs for left, top, right, bottom in [run.font.getbbox(run.text)]]
+            left, top = math.floor(min(box[0] for box in boxes)), math.floor(min(box[1] for box in boxes))
+            right, bottom = math.ceil(max(box[2] for box in boxes)), math.ceil(max(box[3] for box in boxes))
+            mask = Image.new("L", (max(1, right - left), max(1, bottom - top)))
+            draw = ImageDraw.Draw(mask)
+            # Shifted by whole pixels, so the glyphs are the ones overlay_txt draws
+            for run in runs:
+                draw.text((run.x - left, run.y - top), run.text, font=run.font, fill=255)
+            sprites.append(Sprite(section, (left, top), mask))
+    return sprites
+
+
+def frame_count(fps=15, seconds=3.0):
+    return max(1, round(fps * seconds))
+
+# Gradient frames whose colors drift across the image and back over the clip: the
+# interpolation ratio (computed once, as one of GRADIENT_LEVELS steps) is shifted by
+# the frame's phase and folded back into range, so the last frame leads smoothly into
+# the first when the clip loops. Each frame is then a lookup in a precomputed color
+# table, with no float arrays of the frame's size.
+GRADIENT_LEVELS = 1024
+
+def gradient_frames(colors, direction="Vertical", size=(1080, 1080), count=45):
+    width, height = size
+    colors = np.array([ImageColor.getrgb(c)[:3] for c in colors], dtype=np.float64)
+    stops = np.linspace(0, 1, len(colors))
+    ramp = np.linspace(0, 1, GRADIENT_LEVELS + 1)
+    table = np.stack([np.interp(ramp, stops, colors[:, c]) for c in range(3)], axis=-1).astype(np.uint8)
+    levels = np.rint(grad_ratio(size, direction) * GRADIENT_LEVELS).astype(np.uint16)
+    for index in range(count):
+        with span("animation_background"):
+            shifted = (levels + round(2 * GRADIENT_LEVELS * index / count)) % (2 * GRADIENT_LEVELS)
+            np.subtract(2 * GRADIENT_LEVELS, shifted, out=shifted, where=shifted > GRADIENT_LEVELS)
+            rgb = np.broadcast_to(table[shifted], (height, width, 3))
+            yield Image.fromarray(np.ascontiguousarray(rgb))
+
+
+def smoothstep(progress):
+    progress = min(max(progress, 0.0), 1.0)
+    return progress * progress * (3 - 2 * progress)
+
+# Entrance progress (0 to 1) of each animated section at time t (0 to 1 over the clip).
+# Entrances take the first `intro` of the clip and overlap by half; the rest holds
+# the finished ad.
+def entrance_progress(t, count, intro=0.6, overlap=0.5):
+    length = intro / (1 + (count - 1) * (1 - overlap)) if count else intro
+    return [smoothstep((t - index * length * (1 - overlap)) / length) for index in range(count)]
+
+# Frames of the animated ad, composited one at a time from the cached sprites: each
+# frame is its background with every visible section pasted in the text color
+# through its (faded) mask. background is a single image for a still background or
+# an iterable of at least frame_count(fps, seconds) frames (e.g. gradient_frames);
+# frames are the full size of the ad. Only the frame being built is held in memory.
+def animate_ad(ad, background, fill, font_path, size=(1080, 1080), fps=15, seconds=3.0,
+               effect="fade", autofit=True):
+    if effect not in EFFECTS:
+        raise ValueError(f"Unknown effect {effect!r}, expected one of {EFFECTS}")
+    fill = ImageColor.getrgb(fill)[:3] if isinstance(fill, str) else tuple(fill)[:3]
+    sprites = text_sprites(ad, font_path, size, autofit)
+    animated = [sprite.section for sprite in sprites if sprite.section in ANIMATED_SECTIONS]
+    slide = round(size[1] * 0.04)
+    count = frame_count(fps, seconds)
+    backgrounds = iter(background) if not isinstance(background, Image.Image) else None
+    for index in range(count):
+        frame = next(backgrounds) if backgrounds else background.copy()
+        if frame.size != tuple(size):
+            raise ValueError(f"Background size {frame.size} does not match animation size {tuple(size)}")
+        progress = dict(zip(animated, entrance_progress(index / count, len(animated))))
+        with span("animation_composite"):
+            for sprite in sprites:
+                amount = progress.get(sprite.section, 1.0)
+                if amount <= 0:
+                    continue
+                mask = sprite.mask
+                if amount < 1:
+                    mask = mask.point([round(value * amount) for value in range(256)])
+                left, top = sprite.position
+                if effect == "slide":
+                    top += round(slide * (1 - amount))
+                frame.paste(fill, (left, top, left + mask.width, top + mask.height), mask)
+        yield frame
+
+
+# Exposes a stream of frames as a multi-frame image (n_frames plus in-order seek),
+# which is how Pillow's animated WebP writer reads its input, so each frame goes to
+# the encoder as soon as it is composited instead of all frames being collected for
+# append_images first
+class FrameStream(Image.Image):
+
+    def __init__(self, frames, count):
+        super().__init__()
+        self._frames = iter(frames)
+        self.n_frames = count
+        self._index = -1
+        self.seek(0)
+
+    def seek(self, index):
+        while self._index < index:
+            frame = next(self._frames)
+            self.im = frame.im
+            self._mode = frame.mode
+            self._size = frame.size
+            self._index += 1
+
+    def tell(self):
+        return self._index
+
+
+# GIF written frame by frame with Pillow's GIF helpers: a header (looping forever)
+# and each frame with its own 256-color palette
+def write_gif(frames, fp, duration):
+    first = True
+    for frame in frames:
+        with span("animation_encode"):
+            frame = frame.quantize(256, method=Image.Quantize.FASTOCTREE)
+            if first:
+                header, _ = GifImagePlugin.getheader(frame, info={"loop": 0, "duration": duration})
+                fp.write(b"".join(header))
+                first = False
+            for chunk in GifImagePlugin.getdata(frame, duration=duration, include_color_table=True):
+                fp.write(chunk)
+    fp.write(b";")
+
+def write_webp(frames, fp, duration, count, quality=80, method=4):
+    with span("animation_encode"):
+        FrameStream(frames, count).save(fp, format="WEBP", save_all=True, duration=duration, loop=0,
+                                        quality=quality, method=method)
+
+# Numbered PNG frames in a zip archive, e.g. for making an MP4 with
+# ffmpeg -framerate <fps> -i frame_%04d.png -pix_fmt yuv420p ad.mp4
+def write_frames(frames, fp, compress_level=1):
+    with zipfile.ZipFile(fp, "w", zipfile.ZIP_STORED) as archive:
+        for index, frame in enumerate(frames, 1):
+            with span("animation_encode"):
+                data = io.BytesIO()
+                frame.save(data, format="PNG", compress_level=compress_level)
+                archive.writestr(f"frame_{index:04d}.png", data.getvalue())
+
+# Output formats by the name shown in the app: (file extension, MIME type)
+ANIMATION_FORMATS = {
+    "GIF": ("gif", "image/gif"),
+    "WebP": ("webp", "image/webp"),
+    "PNG frames (.zip)": ("zip", "application/zip"),
+}
+
+# Streams the frames of animate_ad (or any frames at fps) into fp in the given format
+def write_animation(frames, fp, format="GIF", fps=15, count=None):
+    duration = round(1000 / fps)
+    if format == "GIF":
+        write_gif(frames, fp, duration)
+    elif format == "WebP":
+        if count is None:
+            raise ValueError("WebP needs the frame count up front")
+        write_webp(frames, fp, duration, count)
+    elif format == "PNG frames (.zip)":
+        write_frames(frames, fp)
+    else:
+        raise ValueError(f"Unknown animation format {format!r}, expected one of {list(ANIMATION_FORMATS)}")
+    return fp
+
+# The animated ad encoded in memory, e.g. for a download button. background is as
+# for animate_ad.
+def encode_animation(ad, background, fill, font_path, format="GIF", size=(1080, 1080), fps=15, seconds=3.0,
+                     effect="fade", autofit=True):
+    frames = animate_ad(ad, background, fill, font_path, size, fps, seconds, effect, autofit)
+    return write_animation(frames, io.BytesIO(), format, fps, frame_count(fps, seconds)).getvalue()
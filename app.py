@@ -1,8 +1,11 @@
 import streamlit as st
 from streamlit_tags import st_tags
 
-from ad_chain import generate_ad
-from image_gen import overlay_txt, gen_grad_bg, gen_solid_bg, process_bg
+from image_gen import FONT_FILES, render_draft, compute_layout, get_bg, preview_size, bg_cache, font_cache, plan_cache, layer_cache, warm_fonts, platform_formats, map_concurrently
+from image_encode import FORMATS, MIME_TYPES, EXTENSIONS, encode_render, store_preview, encode_preview, load_render, encoded_cache, render_bundle
+from artifact_store import get_artifact_store
+from animation import ANIMATION_FORMATS, encode_animation, frame_count, gradient_frames
+from tracing import begin_trace, end_trace, default_recorder, serve_metrics
 
 import io
 import os
@@ -10,10 +13,71 @@ import os
 import hashlib
 import io
 import json
+import sys
+import threading
 
 api_key = st.secrets["GOOGLE_API_KEY"]
 os.environ["GOOGLE_API_KEY"] = api_key
 
+# Every script run is one traced request: the stages below (Gemini, background,
+# layout, drawing, encoding...) are timed into it and it is recorded at the end.
+# Set ADCRAFT_METRICS_PORT to expose the per-stage timings at :<port>/metrics.
+request_trace = begin_trace("request")
+if os.environ.get("ADCRAFT_METRICS_PORT"):
+    serve_metrics(int(os.environ["ADCRAFT_METRICS_PORT"]))
+
+# The LLM stack (ad_chain: LangChain, Gemini client, pydantic) takes longer to import
+# than everything else the page needs, and most reruns never use it. It is imported
+# where an ad is generated, and warmed up by a background thread once per process
+# after the first page has been drawn (see the end of this script).
+@st.cache_resource(show_spinner=False)
+def start_llm_warmup():
+    def warm():
+        try:
+            import ad_chain
+            ad_chain.warm_up()
+        except Exception:
+            pass  # the first generation reports the problem
+    thread = threading.Thread(target=warm, name="llm-warmup", daemon=True)
+    thread.start()
+    return thread
+
+# Every font face is loaded once per process so the first render isn't slower than the rest
+@st.cache_resource(show_spinner=False)
+def warm_font_faces():
+    warm_fonts(FONT_FILES.values())
+
+# Size of the generated ad; what is shown on screen is a preview at preview_size(AD_SIZE)
+AD_SIZE = (1080, 1080)
+
+# Seconds without a restyle after which the full-resolution download is rendered ahead
+FULL_RENDER_IDLE_SECONDS = 2.0
+
+def background_at(spec, size=AD_SIZE):
+    style, colors, direction, upload_key = spec
+    return get_bg(style, colors, direction, size, upload_key=upload_key)
+
+# Background frames for the animated version: a gradient drifts across the ad, solid
+# and image backgrounds stay still
+def animation_background(spec, size=AD_SIZE):
+    style, colors, direction, upload_key = spec
+    if style == "Gradient":
+        return gradient_frames(colors, direction, size, frame_count())
+    return background_at(spec, size)
+
+# Renders and encodes the full-resolution download in a background thread once the
+# session has stopped restyling for a while, so clicking Download doesn't wait for it.
+# Each restyle cancels the session's pending render.
+def render_full_when_idle(ad, spec, fill, font_path, autofit, settings):
+    pending = st.session_state.get("full_render_timer")
+    if pending is not None:
+        pending.cancel()
+    timer = threading.Timer(FULL_RENDER_IDLE_SECONDS, lambda: encode_render(
+        ad, background_at(spec), fill, font_path, autofit, settings=settings))
+    timer.daemon = True
+    timer.start()
+    st.session_state.full_render_timer = timer
+
 st.set_page_config(layout="wide")
 
 # Custom CSS to control padding (balanced – not too tight, not too wide)
@@ -110,6 +174,10 @@ with inp_col2:
     word_limit = st.slider("Word Limit", min_value=50, max_value=75, value=50)
     temperature = st.slider("Creativity ", min_value=0.0, max_value=1.0, value=0.7, step=0.05)
     include_hashtags = st.checkbox("Include Hashtags", value=True)
+    n_variants = st.number_input("Ad options", min_value=1, max_value=4, value=1,
+                                 help="Generate several alternative ads in a single request")
+    replay = st.checkbox("Reuse previous results", value=False,
+                         help="Deterministic replay: serve a cached ad when these exact details were generated before")
     
     submitted=st.button("Generate Ad")
            
@@ -134,10 +202,11 @@ input_data = {
     "include_hashtags": include_hashtags,
 }
 
-form_hash = hashlib.md5(json.dumps({**input_data,"temperature": temperature}, sort_keys=True).encode()).hexdigest()
+form_hash = hashlib.md5(json.dumps({**input_data,"temperature": temperature, "n_variants": n_variants, "replay": replay},
+                                     sort_keys=True).encode()).hexdigest()
 
 if "form_hash" in st.session_state and st.session_state.form_hash != form_hash:
-    keys_to_reset = ["generated_ad", "ad_image", "restyle_trigger", "restyle", "missing_bg_warning"]
+    keys_to_reset = ["generated_ad", "ad_variants", "ad_image", "ad_render", "restyle_trigger", "restyle", "missing_bg_warning"]
     for key in keys_to_reset:
         st.session_state.pop(key, None)
 
@@ -151,39 +220,57 @@ with styling_col:
     st.text("Styling Options")
     
     text_font = st.selectbox("Text Font", [ "Arial", "Georgia", "Montserrat","Pacifico","Anton"], key="txt_font")
-    font_dict = {
-        "Arial": "fonts/OpenSans-VariableFont_wdth,wght.ttf",
-        "Georgia": "fonts/LibreBaskerville-Regular.ttf",
-        "Montserrat": "fonts/Montserrat-Italic-VariableFont_wght.ttf",
-        "Pacifico": "fonts/Pacifico-Regular.ttf",
-        "Anton": "fonts/Anton-Regular.ttf"
-    }
+    font_dict = FONT_FILES
+    warm_font_faces()
     Font = font_dict[text_font]
     
     text_color = st.color_picker("Font Color", "#000000")  
+    autofit = st.checkbox("Auto-fit text", value=True, help="Shrink the headline and body if they would overlap the contact details")
     
     bg_style = st.selectbox("Background Style", ["Solid", "Gradient", "Image"], key="bg_style")
+    # (style, colors, direction, upload key): all it takes to get the background at any
+    # size, for the other platform formats. Uploads are kept once in the artifact store.
+    bg_spec = None
 
     if bg_style == "Solid":
         color = st.color_picker("Background Color", "#FFFFFF", key="solid_color")
-        bg = gen_solid_bg(color)
+        bg_spec = ("Solid", (color,), None, None)
 
     elif bg_style == "Gradient":
         start_color = st.color_picker("Start Color", "#FFFFFF", key="grad_start")
         end_color = st.color_picker("End Color", "#FFFFFF", key="grad_end")
         direction = st.selectbox("Gradient Direction",["Vertical","Horizontal","Diagonal"])
-        bg = gen_grad_bg(start_color,end_color,direction)
+        bg_spec = ("Gradient", (start_color, end_color), direction, None)
 
     elif bg_style == "Image":
         
         start_color = None
         end_color = None
-        bg = st.file_uploader("Upload Background Image", type=["png", "jpg", "jpeg"], key="bg_img")
+        upload = st.file_uploader("Upload Background Image", type=["png", "jpg", "jpeg"], key="bg_img")
         
-        if bg is not None:
-            bg = process_bg(bg)
+        if upload is not None:
+            bg_spec = ("Image", (), None, get_artifact_store().put(upload.getvalue()))
 
     
+# Cache counters and Gemini queue stats for checking a live deployment (?debug=1)
+if st.query_params.get("debug"):
+    scheduler_stats = None
+    if "ad_chain" in sys.modules:
+        from ad_chain import get_scheduler  # waits for the warm-up thread's import to finish
+        scheduler_stats = get_scheduler().stats()
+    st.sidebar.json({
+        "background_cache": bg_cache.stats(),
+        "font_cache": font_cache.stats(),
+        "layout_cache": plan_cache.stats(),
+        "text_layer_cache": layer_cache.stats(),
+        "encoded_image_cache": encoded_cache.stats(),
+        "artifact_store": get_artifact_store().stats(),
+        "gemini_scheduler": scheduler_stats,
+    })
+    if st.session_state.get("generated_ad") and bg_spec is not None:
+        plan = compute_layout(st.session_state.generated_ad, Font, AD_SIZE, autofit=autofit)
+        st.sidebar.json({"autofit_scale": plan.scale, "autofit_probes": plan.probes})
+
 required_fields = [company_name or "", product_name or "", product_description or "", platform or "", cta or "",
                    phone or "", email or "", website or "", location or ""]
 all_required_filled = all(field.strip() for field in required_fields)
@@ -192,12 +279,40 @@ all_required_filled = all(field.strip() for field in required_fields)
         
 if not st.session_state.get("generated_ad") and all_required_filled:
     
-    if submitted:
+    if submitted and n_variants > 1:
+        with out_col:
+            with st.spinner("Generating..."):
+                from ad_chain import generate_ads
+                ads = generate_ads(input_data, temperature, n=n_variants, replay=replay)
+            if ads:
+                st.session_state.ad_variants = ads
+                st.session_state.generated_ad = ads[0]
+                st.session_state.restyle_trigger = True
+            else:
+                st.error("Could not generate ad options, please try again.")
+
+    elif submitted:
         with out_col:
+            preview = st.empty()
             with st.spinner("Generating..."):
-                ad = generate_ad(input_data, temperature)
-            st.session_state.generated_ad = ad
-            st.session_state.restyle_trigger = True
+                # Redraw a low-resolution draft as the headline and body stream in
+                from ad_chain import OutputParserException, stream_ad
+                bg = background_at(bg_spec) if bg_spec else None
+                ad, drawn = None, None
+                try:
+                    for ad in stream_ad(input_data, temperature, replay=replay):
+                        progress = (len(ad.get("headline", "").split()), len(ad.get("text", "").split()) // 8)
+                        if bg is not None and progress != drawn and any(progress):
+                            preview.image(render_draft(ad, bg, text_color, Font, autofit=autofit))
+                            drawn = progress
+                except OutputParserException:
+                    ad = None
+            preview.empty()
+            if ad:
+                st.session_state.generated_ad = ad
+                st.session_state.restyle_trigger = True
+            else:
+                st.error("Could not generate an ad, please try again.")
         # st.rerun()
         
 elif not all_required_filled:
@@ -209,40 +324,98 @@ if st.session_state.get("generated_ad"):
     
     ad = st.session_state.generated_ad
     
-    if st.session_state.get("restyle", True):  
-        if bg_style == "Image" and bg is None:
+    if st.session_state.get("restyle", True) or st.session_state.get("restyle_trigger"):
+        if bg_spec is None:
             with styling_col:
                 st.info("Please upload a background image.")
         else:
-            img = overlay_txt(
-                ad,
-                bg,
-                text_color,
-                Font
-            )
-            img_bytes = io.BytesIO()
-            img.save(img_bytes, format="PNG")
-            img_bytes.seek(0)
-            st.session_state.ad_image = img_bytes
+            # What is shown is an instant preview: the full-size layout drawn with scaled
+            # fonts over a preview-sized background, stored once for every identical
+            # render. The full-resolution file is rendered on download, or ahead of it
+            # once the styling has stopped changing. The session keeps only the
+            # preview's key and what it takes to render it again.
+            preview_bg = background_at(bg_spec, preview_size(AD_SIZE))
+            st.session_state.ad_image = store_preview(ad, preview_bg, text_color, Font, AD_SIZE, autofit)
+            st.session_state.ad_render = (ad, bg_spec, text_color, Font, autofit)
             st.session_state.restyle_trigger = False
+            render_full_when_idle(ad, bg_spec, text_color, Font, autofit,
+                                  FORMATS[st.session_state.get("download_format", "PNG")])
     
     
     with out_col:
-        
-        st.image(st.session_state.ad_image, use_container_width=True)
 
+        # Thumbnails of every option; they share the background and cached layouts
+        variants = st.session_state.get("ad_variants", [])
+        if len(variants) > 1 and bg_spec is not None:
+            thumb_bg = background_at(bg_spec, preview_size(AD_SIZE, AD_SIZE[0] // 4))
+            for i, (col, variant) in enumerate(zip(st.columns(len(variants)), variants)):
+                with col:
+                    st.image(encode_preview(variant, thumb_bg, text_color, Font, AD_SIZE, autofit),
+                             use_container_width=True)
+                    if st.button(f"Use option {i + 1}", key=f"use_variant_{i}", disabled=variant == ad):
+                        st.session_state.generated_ad = variant
+                        st.session_state.restyle_trigger = True
+                        st.rerun()
+
+        ad_, spec_, fill_, font_, autofit_ = st.session_state.ad_render
+        preview_image = load_render(st.session_state.ad_image)
+        if preview_image is None:  # evicted from the store since it was rendered
+            preview_image = encode_preview(ad_, background_at(spec_, preview_size(AD_SIZE)), fill_, font_,
+                                           AD_SIZE, autofit_)
+        st.image(preview_image, use_container_width=True)
+
+        download_format = st.selectbox("Download format", list(FORMATS), key="download_format")
+        settings = FORMATS[download_format]
         st.download_button(
             label="Download Ad",
-            data=st.session_state.ad_image,
-            file_name="ad_image.png",
-            mime="image/png",
+            data=lambda: encode_render(ad_, background_at(spec_), fill_, font_, autofit_, settings=settings),
+            file_name=f"ad_image.{EXTENSIONS[settings['format']]}",
+            mime=MIME_TYPES[settings["format"]],
             icon=":material/download:",
         )
+
+        # The same ad at every size the platform uses, from the one generation
+        formats = platform_formats(platform)
+        if len(formats) > 1:
+            with st.expander(f"All {platform} formats"):
+                background = lambda size: background_at(spec_, size)
+                thumbs = map_concurrently(
+                    lambda fmt: encode_preview(ad_, background(preview_size(fmt[1], fmt[1][0] // 4)), fill_, font_,
+                                               fmt[1], True), formats)
+                for col, (name, (width, height)), thumb in zip(st.columns(len(formats)), formats, thumbs):
+                    col.image(thumb, caption=f"{name} {width}x{height}")
+                st.download_button(
+                    label="Download all formats (.zip)",
+                    data=lambda: render_bundle(ad_, background, fill_, font_, formats, settings,
+                                               prefix=f"ad_{platform.lower()}"),
+                    file_name=f"ad_{platform.lower()}_formats.zip",
+                    mime="application/zip",
+                    icon=":material/download:",
+                    key="download_formats",
+                )
+
+        # A short animated version: the headline, body, CTA and hashtags come in one after
+        # the other. Frames are composited and encoded one at a time when downloaded.
+        with st.expander("Animated version"):
+            effect_col, format_col = st.columns(2)
+            effect = effect_col.selectbox("Effect", ["fade", "slide"], key="animation_effect",
+                                          format_func=lambda name: {"fade": "Fade in", "slide": "Slide up"}[name])
+            animation_format = format_col.selectbox("Format", list(ANIMATION_FORMATS), key="animation_format")
+            extension, mime = ANIMATION_FORMATS[animation_format]
+            st.download_button(
+                label="Download animation",
+                data=lambda: encode_animation(ad_, animation_background(spec_), fill_, font_, animation_format,
+                                              AD_SIZE, effect=effect, autofit=autofit_),
+                file_name=f"ad_animated.{extension}",
+                mime=mime,
+                icon=":material/download:",
+                key="download_animation",
+            )
             
     with styling_col:
         
         if st.button("Re-style", icon=":material/refresh:", key="restyle"):
-            if bg_style == "Image" and bg is None:
+            if bg_spec is None:
                 st.session_state["missing_bg_warning"] = True
             else:
                 st.session_state["restyle_trigger"] = True
@@ -257,3 +430,15 @@ if st.session_state.get("generated_ad"):
 
 
         
+
+
+end_trace(request_trace)
+
+start_llm_warmup()
+
+# Where this run's time went, and p50/p95 per stage over the process's recent runs (?debug=1)
+if st.query_params.get("debug"):
+    st.sidebar.json({
+        "this_run_ms": request_trace.to_dict(),
+        "recent": default_recorder.stage_stats(),
+    })
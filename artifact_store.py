@@ -0,0 +1,143 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+
+# Content-addressed blobs (encoded renders, uploaded backgrounds) in a local
+# directory shared by every session of the process, bounded to max_bytes with LRU
+# eviction. Sessions keep only the keys; the bytes live on disk once, however many
+# sessions show them. Blobs are written to a temporary file and renamed into place,
+# so readers never see a partial file.
+class ArtifactStore:
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._sizes = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    # Picks up the blobs of an earlier run, least recently used first
+    def _load(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._sizes[key] = size
+            self.nbytes += size
+        with self._lock:
+            self._evict()
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __contains__(self, key):
+        return key in self._sizes
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._sizes:
+                self.misses += 1
+                return default
+            self._sizes.move_to_end(key)
+            self.hits += 1
+        try:
+            with open(self.path(key), "rb") as blob:
+                return blob.read()
+        except FileNotFoundError:  # removed from the directory behind our back
+            self._forget(key)
+            return default
+
+    # Stores data under key (by default its SHA-256) and returns the key
+    def put(self, data, key=None):
+        key = key or hashlib.sha256(data).hexdigest()
+        if key in self._sizes:
+            with self._lock:
+                if key in self._sizes:
+                    self._sizes.move_to_end(key)
+                    return key
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return key
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "wb") as blob:
+            blob.write(data)
+        os.replace(tmp_path, self.path(key))
+        with self._lock:
+            if key not in self._sizes:
+                self.nbytes += len(data)
+            self._sizes[key] = len(data)
+            self._evict()
+        return key
+
+    def get_or_create(self, key, factory):
+        data = self.get(key, _MISSING)
+        if data is _MISSING:
+            # Built outside the lock so slow factories don't block other sessions
+            data = factory()
+            self.put(data, key)
+        return data
+
+    def clear(self):
+        with self._lock:
+            for key in self._sizes:
+                self._remove(key)
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "root": self.root,
+            "entries": len(self._sizes),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _forget(self, key):
+        with self._lock:
+            if key in self._sizes:
+                self.nbytes -= self._sizes.pop(key)
+
+    def _remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._sizes and self.max_bytes is not None and self.nbytes > self.max_bytes:
+            key, size = self._sizes.popitem(last=False)
+            self._remove(key)
+            self.nbytes -= size
+            self.evictions += 1
+
+
+_MISSING = object()
+
+
+# The process-wide store. Set ADCRAFT_ARTIFACT_DIR to keep it somewhere else than
+# the temp directory (e.g. a local SSD or a tmpfs) and ADCRAFT_ARTIFACT_MB to size it.
+@lru_cache(maxsize=None)
+def get_artifact_store():
+    return ArtifactStore(
+        root=os.environ.get("ADCRAFT_ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "adcraft-artifacts")),
+        max_bytes=int(os.environ.get("ADCRAFT_ARTIFACT_MB", 512)) * 1024 * 1024,
+    )
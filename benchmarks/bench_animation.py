@@ -0,0 +1,91 @@
+# Frames/sec and peak memory of the animated export (animation.py) per output format,
+# compared with the naive approach: gen_grad_bg + overlay_txt for every frame, all
+# frames collected in a list and saved with Pillow's save_all. Each case runs in its
+# own process so its peak resident memory is measured on its own.
+# Run from the repo root: python benchmarks/bench_animation.py [--fps 15 --seconds 3]
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import ImageColor
+
+import animation
+from image_gen import FONT_FILES, gen_grad_bg, overlay_txt, warm_fonts
+
+COLORS = ("#FFEEDD", "#3366CC")
+SIZE = (1080, 1080)
+
+
+def sample_ad():
+    with open("examples.json") as f:
+        return json.load(f)[0]["ad_output_json"]
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def naive(ad, count, fps):
+    frames = []
+    for index in range(count):
+        # The same color drift as gradient_frames, one full gradient and overlay per frame
+        phase = abs(1 - 2 * index / count)
+        start = np.array(ImageColor.getrgb(COLORS[0])) * phase + \
+            np.array(ImageColor.getrgb(COLORS[1])) * (1 - phase)
+        start = "#%02x%02x%02x" % tuple(int(c) for c in start)
+        frames.append(overlay_txt(ad, gen_grad_bg(start, COLORS[1], "Diagonal", SIZE), "#000000",
+                                  FONT_FILES["Arial"], autofit=True))
+    output = io.BytesIO()
+    frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:], duration=round(1000 / fps), loop=0)
+    return output.getvalue()
+
+def streamed(ad, count, fps, seconds, format):
+    frames = animation.animate_ad(ad, animation.gradient_frames(COLORS, "Diagonal", SIZE, count), "#000000",
+                                  FONT_FILES["Arial"], SIZE, fps, seconds)
+    return animation.write_animation(frames, io.BytesIO(), format, fps, count).getvalue()
+
+def run_case(case, fps, seconds):
+    ad = sample_ad()
+    warm_fonts([FONT_FILES["Arial"]])
+    count = animation.frame_count(fps, seconds)
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    if case == "naive GIF":
+        data = naive(ad, count, fps)
+    else:
+        data = streamed(ad, count, fps, seconds, case)
+    elapsed = time.perf_counter() - start
+    return {"frames": count, "seconds": elapsed, "bytes": len(data), "peak_mb": peak_rss_mb() - before}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fps", type=int, default=15)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.fps, args.seconds)))
+        return
+
+    cases = ["naive GIF"] + list(animation.ANIMATION_FORMATS)
+    print(f"{SIZE[0]}x{SIZE[1]}, {args.fps} fps, {args.seconds:g} s "
+          f"({animation.frame_count(args.fps, args.seconds)} frames)\n")
+    print(f"{'case':<20}{'frames/s':>10}{'total (s)':>11}{'size (KB)':>11}{'peak +MB':>10}")
+    for case in cases:
+        proc = subprocess.run([sys.executable, __file__, "--case", case, "--fps", str(args.fps),
+                               "--seconds", str(args.seconds)], capture_output=True, text=True, check=True)
+        result = json.loads(proc.stdout.splitlines()[-1])
+        print(f"{case:<20}{result['frames'] / result['seconds']:>10.1f}{result['seconds']:>11.2f}"
+              f"{result['bytes'] / 1024:>11.0f}{result['peak_mb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Throughput of generate_ads_batch against a local fake chat model with injected
+# latency (and a few transient failures), compared with calling generate_ad in a loop.
+# Run from the repo root: python benchmarks/bench_batch.py
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.language_models import FakeListChatModel
+
+import ad_chain
+
+
+# Fake Gemini: sleeps `latency` seconds (x0.5-2 jitter, non-blocking when awaited)
+# and fails a fraction of calls
+class SlowFakeChatModel(FakeListChatModel):
+    latency: float = 0.2
+    failure_rate: float = 0.0
+
+    def _delay(self):
+        if random.random() < self.failure_rate:
+            raise RuntimeError("injected failure")
+        return self.latency * random.uniform(0.5, 2.0)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self._delay())
+        return super()._generate(messages, stop, run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._delay())
+        return super()._generate(messages, stop, None, **kwargs)
+
+
+def make_inputs(n):
+    examples = ad_chain.load_few_shot_examples()
+    inputs = []
+    for i in range(n):
+        example = {k: v for k, v in examples[i % len(examples)].items() if k != "ad_output_json"}
+        inputs.append({**example, "product_name": f"{example['product_name']} #{i}"})
+    return inputs
+
+
+def main():
+    responses = [json.dumps(e["ad_output_json"]) for e in ad_chain.load_few_shot_examples()]
+    n, latency = 200, 0.2
+    inputs = make_inputs(n)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ad_chain.ResponseCache(os.path.join(tmp, "bench.sqlite3"))
+
+        model = SlowFakeChatModel(responses=responses, latency=latency)
+        ad_chain.get_model = lambda: model
+        ad_chain.setup_llm_chain.cache_clear()
+        scheduler = ad_chain.GeminiScheduler()  # no quota limits for the fake model
+        ad_chain.get_scheduler = lambda: scheduler
+
+        sequential_n = 20
+        start = time.perf_counter()
+        for input_data in inputs[:sequential_n]:
+            ad_chain.generate_ad(input_data, 0.7, cache=cache)
+        sequential = sequential_n / (time.perf_counter() - start)
+        print(f"sequential generate_ad: {sequential:7.1f} ads/s ({sequential_n} ads, ~{latency * 1.25:.2f}s mean latency)")
+
+        for concurrency in [4, 16, 64]:
+            for failure_rate in [0.0, 0.05]:
+                model.failure_rate = failure_rate
+                start = time.perf_counter()
+                first = None
+                ok = 0
+                for result in ad_chain.generate_ads_batch(inputs, concurrency=concurrency, backoff=0.05, cache=cache):
+                    first = first or time.perf_counter() - start
+                    ok += result.ad is not None
+                elapsed = time.perf_counter() - start
+                print(f"batch concurrency={concurrency:<3} failures={failure_rate:.0%}: "
+                      f"{n / elapsed:7.1f} ads/s, {ok}/{n} ok, first result after {first * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
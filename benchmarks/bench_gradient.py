@@ -0,0 +1,67 @@
+# Compares the vectorized gradient engine against the original per-pixel loop.
+# Run from the repo root: python benchmarks/bench_gradient.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageColor
+import numpy as np
+
+from image_gen import gen_grad_bg, gen_multi_grad_bg
+
+
+# Original implementation, kept here only as the reference for the benchmark
+def legacy_gen_grad_bg(start_color, end_color, direction):
+    start_color = ImageColor.getrgb(start_color)
+    end_color = ImageColor.getrgb(end_color)
+    img = Image.new("RGB", (1080, 1080))
+    draw = ImageDraw.Draw(img)
+    for y in range(1080):
+        for x in range(1080):
+            ratio = {
+                "Vertical": y / 1080,
+                "Horizontal": x / 1080,
+                "Diagonal": (x + y) / (2 * 1080)
+            }.get(direction, 0)
+            r = int(start_color[0] * (1 - ratio) + end_color[0] * ratio)
+            g = int(start_color[1] * (1 - ratio) + end_color[1] * ratio)
+            b = int(start_color[2] * (1 - ratio) + end_color[2] * ratio)
+            draw.point((x, y), fill=(r, g, b))
+    return img
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    start_color, end_color = "#FF5733", "#1E90FF"
+    print(f"{'direction':<12}{'legacy (s)':>12}{'numpy (ms)':>12}{'speedup':>10}{'max diff':>10}")
+    for direction in ["Vertical", "Horizontal", "Diagonal"]:
+        legacy_img = legacy_gen_grad_bg(start_color, end_color, direction)
+        new_img = gen_grad_bg(start_color, end_color, direction)
+        diff = np.abs(np.asarray(legacy_img, dtype=np.int16) - np.asarray(new_img, dtype=np.int16)).max()
+
+        legacy = best_of(lambda: legacy_gen_grad_bg(start_color, end_color, direction), 1)
+        new = best_of(lambda: gen_grad_bg(start_color, end_color, direction), 5)
+        print(f"{direction:<12}{legacy:>12.2f}{new * 1000:>12.1f}{legacy / new:>9.0f}x{diff:>10}")
+
+    extra = {
+        "Radial": lambda: gen_grad_bg(start_color, end_color, "Radial"),
+        "Angle 30": lambda: gen_grad_bg(start_color, end_color, "Angle", angle=30),
+        "3-stop": lambda: gen_multi_grad_bg([start_color, "#FFFFFF", end_color], "Vertical"),
+        "1080x1920": lambda: gen_grad_bg(start_color, end_color, "Diagonal", size=(1080, 1920)),
+    }
+    for name, fn in extra.items():
+        print(f"{name:<12}{'-':>12}{best_of(fn, 5) * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
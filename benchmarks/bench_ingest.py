@@ -0,0 +1,83 @@
+# Decode time and peak memory of turning a large JPEG upload into a 1080x1080 background.
+# Each measurement runs in a fresh interpreter and reads the peak RSS (VmHWM, Linux only)
+# around the decode, so the numbers are for that method alone.
+# Run from the repo root: python benchmarks/bench_ingest.py
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from PIL import Image
+
+METHODS = {
+    # What process_bg did before: full decode, then an unscaled center crop
+    "legacy": """
+img = Image.open(path)
+w, h = img.size
+left, top = (w - 1080) / 2, (h - 1080) / 2
+img.crop((left, top, left + 1080, top + 1080)).convert("RGB")
+""",
+    # Same output as process_bg, without draft decoding
+    "full decode + resize": """
+img = Image.open(path).convert("RGB")
+w, h = img.size
+s = 1080 / min(w, h)
+img = img.resize((round(w * s), round(h * s)), Image.Resampling.LANCZOS)
+w, h = img.size
+img.crop(((w - 1080) // 2, (h - 1080) // 2, (w + 1080) // 2, (h + 1080) // 2))
+""",
+    "process_bg": """
+process_bg(path)
+""",
+}
+
+RUNNER = """
+import sys, time
+sys.path.insert(0, {root!r})
+from PIL import Image
+from image_gen import process_bg
+
+def peak_kb():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmHWM"))
+
+path = {path!r}
+base = peak_kb()
+start = time.perf_counter()
+{body}
+elapsed = time.perf_counter() - start
+print(elapsed, (peak_kb() - base) / 1024)
+"""
+
+
+def make_jpeg(path, size):
+    # Smooth noise upscaled, so the file compresses like a photo rather than flat color
+    small = (np.random.default_rng(0).random((size[1] // 16, size[0] // 16, 3)) * 255).astype(np.uint8)
+    Image.fromarray(small).resize(size, Image.Resampling.BICUBIC).save(path, "JPEG", quality=90)
+
+
+def measure(path, body):
+    out = subprocess.run(
+        [sys.executable, "-c", RUNNER.format(root=ROOT, path=path, body=body)],
+        capture_output=True, text=True, check=True,
+    ).stdout.split()
+    return float(out[0]), float(out[1])
+
+
+def main():
+    print(f"{'upload':<12}{'method':<24}{'time (ms)':>10}{'peak MB':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [(1600, 1200), (4032, 3024), (6000, 4000)]:
+            path = os.path.join(tmp, f"{size[0]}x{size[1]}.jpg")
+            make_jpeg(path, size)
+            for name, body in METHODS.items():
+                elapsed, peak = min(measure(path, body) for _ in range(3))
+                print(f"{size[0]}x{size[1]:<7}{name:<24}{elapsed * 1000:>10.1f}{peak:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Estimated prompt tokens with every few-shot example vs. the relevance-selected
+# ones, for the bundled examples.json and for a larger synthetic example library,
+# and prompt tokens per ad when several variants are requested in one call.
+# Run from the repo root: python benchmarks/bench_prompt_tokens.py
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.runnables import RunnablePassthrough
+
+import ad_chain
+from example_selector import estimate_tokens
+
+QUERIES = [
+    ("Artisan bakery opening downtown with sourdough and croissants", "Instagram", "warm, friendly", "foodies, families"),
+    ("Home workout app with yoga and HIIT classes", "Facebook", "energetic", "busy parents"),
+    ("Bamboo toothbrushes and zero-waste bathroom kits", "Instagram", "eco-friendly, caring", "eco-conscious shoppers"),
+    ("Noise-cancelling wireless headphones with 40h battery", "Twitter", "bold, techy", "commuters, gamers"),
+    ("Weekend coding bootcamp for beginners", "LinkedIn", "professional, motivating", "career switchers"),
+    ("Cold brew coffee subscription delivered weekly", "Instagram", "cozy", "young professionals"),
+]
+
+CATEGORIES = [
+    "Organic skincare line with vitamin C serums", "Electric scooter rental across the city",
+    "Meal-prep delivery with high-protein plans", "Handmade ceramic mugs and bowls",
+    "Pet grooming salon with spa packages", "Budgeting app that tracks spending automatically",
+    "Kids' summer camp with science workshops", "Vintage clothing thrift store",
+    "Indoor plant shop with care guides", "Language learning podcast for travellers",
+    "Craft brewery taproom with live music", "Solar panel installation for homes",
+    "Online piano lessons for adults", "Boutique hotel by the beach",
+    "Gaming laptop with RTX graphics", "Farmers market with local produce",
+]
+
+
+def query_input(description, platform, tone, audience):
+    base = {k: v for k, v in ad_chain.load_few_shot_examples()[0].items() if k != "ad_output_json"}
+    return {**base, "product_description": description, "platform": platform, "tone": tone, "audience": audience}
+
+
+def synthetic_library(size):
+    examples = ad_chain.load_few_shot_examples()
+    library = []
+    for i in range(size):
+        example = dict(examples[i % len(examples)])
+        example["product_description"] = CATEGORIES[i % len(CATEGORIES)] + f" (variant {i})"
+        library.append(example)
+    return library
+
+
+def prompt_tokens(input_data, n=1):
+    if n > 1:
+        prompt = (RunnablePassthrough.assign(examples=ad_chain.select_example_messages, n_variants=lambda _: n)
+                  | ad_chain.get_prompt(variants=True))
+    else:
+        prompt = RunnablePassthrough.assign(examples=ad_chain.select_example_messages) | ad_chain.get_prompt()
+    return estimate_tokens("".join(m.content for m in prompt.invoke(input_data).to_messages()))
+
+
+def run(library, k, budget, queries):
+    ad_chain.load_few_shot_examples = lambda file_path="examples.json": library
+    ad_chain.FEW_SHOT_K, ad_chain.FEW_SHOT_TOKEN_BUDGET = k, budget
+    ad_chain.get_few_shot.cache_clear()
+    start = time.perf_counter()
+    tokens = [prompt_tokens(q) for q in queries]
+    return sum(tokens) / len(tokens), (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    queries = [query_input(*q) for q in QUERIES]
+    bundled = ad_chain.load_few_shot_examples()
+    k, budget = ad_chain.FEW_SHOT_K, ad_chain.FEW_SHOT_TOKEN_BUDGET
+
+    print(f"selection: k={k}, token budget={budget}")
+    print(f"{'library':<18}{'all examples':>14}{'selected':>10}{'saved':>8}{'select+format ms':>18}")
+    for name, library in [("examples.json (3)", bundled), ("synthetic (20)", synthetic_library(20)),
+                          ("synthetic (100)", synthetic_library(100))]:
+        full, _ = run(library, None, None, queries)
+        selected, per_query = run(library, k, budget, queries)
+        print(f"{name:<18}{full:>14.0f}{selected:>10.0f}{1 - selected / full:>8.0%}{per_query * 1000:>18.2f}")
+
+    run(bundled, k, budget, queries)
+    print()
+    print(f"{'variants':<10}{'prompt tokens':>14}{'per ad':>8}")
+    for n in [1, 2, 3, 4]:
+        tokens = sum(prompt_tokens(q, n) for q in queries) / len(queries)
+        print(f"{n:<10}{tokens:>14.0f}{tokens / n:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# Behaviour of the shared Gemini scheduler under a burst of sessions, against the
+# local fake chat model from bench_batch: peak concurrent calls, queue depth and
+# wait times, single-flight coalescing of duplicate requests, priorities, and the
+# request rate including repair calls and the async batch path. Each scenario
+# asserts what it shows, so the script fails if the scheduler stops doing it.
+# Run from the repo root: python benchmarks/bench_scheduler.py
+import os
+import sys
+import tempfile
+import threading
+import time
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ad_chain
+from bench_batch import SlowFakeChatModel, make_inputs
+
+
+# Fake Gemini that records how many calls run at once
+class CountingFakeChatModel(SlowFakeChatModel):
+    calls: int = 0
+    running: int = 0
+    peak: int = 0
+    started: list = []
+
+    def _start(self):
+        with lock:
+            self.calls += 1
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            self.started.append(time.monotonic())
+
+    def _end(self):
+        with lock:
+            self.running -= 1
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self._start()
+        try:
+            return super()._generate(messages, stop, run_manager, **kwargs)
+        finally:
+            self._end()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self._start()
+        try:
+            return await super()._agenerate(messages, stop, run_manager, **kwargs)
+        finally:
+            self._end()
+
+lock = threading.Lock()
+
+
+# Fires one thread per input (like that many sessions clicking at once) and
+# returns per-call latencies in input order
+def burst(inputs, cache, priorities=None, start_delays=None):
+    latencies = [None] * len(inputs)
+
+    def session(i):
+        time.sleep((start_delays or {}).get(i, 0))
+        start = time.perf_counter()
+        ad_chain.generate_ad(inputs[i], 0.7, cache=cache, priority=(priorities or {}).get(i, 0))
+        latencies[i] = time.perf_counter() - start
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    max_depth = 0
+    while any(thread.is_alive() for thread in threads):
+        max_depth = max(max_depth, ad_chain.get_scheduler().stats()["queue_depth"])
+        time.sleep(0.005)
+    return latencies, max_depth
+
+
+# Most model calls started in any `window` seconds
+def max_calls_in_window(started, window):
+    started = sorted(started)
+    return max((sum(1 for t in started[i:] if t < start + window) for i, start in enumerate(started)), default=0)
+
+def run(name, scheduler, model, inputs, cache, **kwargs):
+    ad_chain.get_scheduler = lambda: scheduler
+    model.calls = model.peak = 0
+    model.started = []
+    start = time.perf_counter()
+    latencies, max_depth = burst(inputs, cache, **kwargs)
+    elapsed = time.perf_counter() - start
+    stats = scheduler.stats()
+    print(f"{name:<34} {len(inputs)} requests in {elapsed:5.2f}s, {model.calls:3} model calls, "
+          f"peak {model.peak:3} concurrent, max queue {max_depth:3}, "
+          f"wait p95 {stats['wait_p95'] * 1000:6.0f}ms, coalesced {stats['coalesced']}")
+    return latencies
+
+
+def main():
+    responses = [json.dumps(e["ad_output_json"]) for e in ad_chain.load_few_shot_examples()]
+    model = CountingFakeChatModel(responses=responses, latency=0.2)
+    ad_chain.get_model = lambda: model
+    ad_chain.setup_llm_chain.cache_clear()
+    inputs = make_inputs(60)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ad_chain.ResponseCache(os.path.join(tmp, "bench.sqlite3"))
+
+        run("no limits", ad_chain.GeminiScheduler(max_concurrency=1000), model, inputs, cache)
+
+        # 300 requests/minute with a burst of 10
+        limited = ad_chain.GeminiScheduler(max_concurrency=4)
+        limited.requests = ad_chain.TokenBucket(300, burst=10)
+        run("4 concurrent, 300 rpm (burst 10)", limited, model, inputs, cache)
+        assert model.peak <= 4, f"{model.peak} concurrent calls with a limit of 4"
+        assert max_calls_in_window(model.started, 2.0) <= 10 + 10, "over 300 rpm (burst 10)"
+
+        # 30 double-clicks of the same form, plus 30 distinct requests
+        duplicates = [inputs[0]] * 30 + inputs[30:]
+        run("30 duplicates + 30 distinct", ad_chain.GeminiScheduler(max_concurrency=8), model, duplicates, cache)
+        assert model.calls == 31, f"{model.calls} model calls for 30 duplicates + 30 distinct requests"
+        assert model.peak <= 8, f"{model.peak} concurrent calls with a limit of 8"
+
+        # One interactive request arriving behind a queue of 40 low priority ones
+        mixed = inputs[:41]
+        latencies = run("40 low priority + 1 high", ad_chain.GeminiScheduler(max_concurrency=4), model, mixed, cache,
+                        priorities={i: 10 for i in range(40)}, start_delays={40: 0.1})
+        print(f"  high priority latency {latencies[40]:.2f}s, low priority median "
+              f"{sorted(latencies[:40])[20]:.2f}s")
+        assert latencies[40] < sorted(latencies[:40])[20], "the high priority request did not go first"
+
+        # Ads that break the output rules: every generation makes a main call plus
+        # field repair calls, and each of them counts against the 300 rpm (burst 10)
+        long_headline = [json.dumps({**json.loads(response), "headline": "A headline far too long to keep"})
+                         for response in responses]
+        repairing = CountingFakeChatModel(responses=long_headline, latency=0.2)
+        ad_chain.get_model = lambda: repairing
+        for cached in (ad_chain.setup_llm_chain, ad_chain.setup_repair_chain):
+            cached.cache_clear()
+        limited = ad_chain.GeminiScheduler(max_concurrency=8)
+        limited.requests = ad_chain.TokenBucket(300, burst=10)
+        run("20 needing repair, 300 rpm", limited, repairing, inputs[:20], cache)
+        assert repairing.calls > 20, "no repair calls were made"
+        assert limited.stats()["charged_calls"] == repairing.calls, "a model call was not charged"
+        assert max_calls_in_window(repairing.started, 2.0) <= 10 + 10, "repair calls went over 300 rpm"
+
+        # The async batch path waits for the same buckets
+        ad_chain.get_model = lambda: model
+        for cached in (ad_chain.setup_llm_chain, ad_chain.setup_repair_chain):
+            cached.cache_clear()
+        limited = ad_chain.GeminiScheduler()
+        limited.requests = ad_chain.TokenBucket(300, burst=10)
+        ad_chain.get_scheduler = lambda: limited
+        model.calls, model.started = 0, []
+        start = time.perf_counter()
+        results = list(ad_chain.generate_ads_batch(inputs[:30], concurrency=16, cache=cache))
+        print(f"{'batch of 30, 300 rpm (burst 10)':<34} {len(results)} requests in "
+              f"{time.perf_counter() - start:5.2f}s, {model.calls:3} model calls")
+        assert all(result.ad for result in results)
+        assert max_calls_in_window(model.started, 2.0) <= 10 + 10, "the batch path went over 300 rpm"
+        print("all checks passed")
+
+
+if __name__ == "__main__":
+    main()
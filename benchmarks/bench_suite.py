@@ -0,0 +1,334 @@
+# Benchmark suite for the rendering pipeline and chain assembly. Times every case,
+# writes the results as JSON and compares them against a stored baseline:
+#
+#   python benchmarks/bench_suite.py                     # run, save, compare with baseline.json
+#   python benchmarks/bench_suite.py --save-baseline     # make this run the new baseline
+#   python benchmarks/bench_suite.py -k overlay --repeat 10
+#
+# A case regresses when its median time exceeds the baseline median by more than
+# --threshold (and by at least --min-delta-ms, so sub-millisecond noise doesn't count);
+# the exit status is then 1. Timings depend on the machine: compare runs from the
+# same one and re-save the baseline when moving to another.
+# Also profiles import times (python -X importtime) of the app's start-up imports
+# and the lazily loaded LLM stack.
+# Run from the repo root.
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+# Encoded renders go to a throwaway artifact store, not the app's
+os.environ.setdefault("ADCRAFT_ARTIFACT_DIR", tempfile.mkdtemp(prefix="adcraft-bench-"))
+
+import numpy as np
+import PIL
+from PIL import Image
+from langchain_core.language_models import FakeListChatModel
+
+import ad_chain
+import image_encode
+import image_gen
+import text_layout
+from artifact_store import get_artifact_store
+from image_gen import (FONT_FILES, OVERLAY_FONT_SIZES, gen_grad_bg, gen_solid_bg, get_fitting_font_size,
+                       get_font, overlay_txt, process_bg, wrap_text_by_width)
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_OUT = os.path.join(BENCH_DIR, "results.json")
+
+SIZE = (1080, 1080)
+UPLOAD_SIZES = [(800, 600), (1920, 1080), (4032, 3024)]
+
+
+# Short ad: the example with the least text. Long ad: the longest example with its
+# body extended by the other examples' bodies, about the form's 75 word maximum.
+def sample_ads():
+    ads = [example["ad_output_json"] for example in ad_chain.load_few_shot_examples()]
+    by_length = sorted(ads, key=lambda ad: len(ad["text"]))
+    short, long = dict(by_length[0]), dict(by_length[-1])
+    long["text"] = " ".join(ad["text"] for ad in reversed(by_length))
+    return {"short": short, "long": long}
+
+# A noisy photo-like upload (so JPEG/PNG decoding does real work), encoded once
+def make_upload(size, fmt):
+    rng = np.random.default_rng(0)
+    w, h = size
+    base = np.linspace(0, 255, w, dtype=np.float32)[None, :, None] * np.ones((h, 1, 3), np.float32)
+    noise = rng.normal(0, 20, (h, w, 3)).astype(np.float32)
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format=fmt, quality=90)
+    return buffer.getvalue()
+
+def clear_layout_caches():
+    image_gen.plan_cache.clear()
+    text_layout.block_cache.clear()
+
+def clear_render_caches():
+    clear_layout_caches()
+    image_gen.layer_cache.clear()
+    image_encode.encoded_cache.clear()
+    get_artifact_store().clear()
+
+def clear_chain_caches():
+    for cached in (ad_chain.setup_llm_chain, ad_chain.get_prompt, ad_chain.get_parser, ad_chain.get_few_shot):
+        cached.cache_clear()
+
+
+# Benchmark cases: name -> (fn, setup). setup runs before every timed call and is
+# not timed (used to clear caches for the cold cases).
+def build_cases():
+    cases = {}
+    ads = sample_ads()
+
+    cases["gen_solid_bg"] = (lambda: gen_solid_bg("#3366CC", SIZE), None)
+    for direction in ["Vertical", "Horizontal", "Diagonal", "Radial"]:
+        cases[f"gen_grad_bg/{direction}"] = (
+            lambda direction=direction: gen_grad_bg("#FF0000", "#0000FF", direction, SIZE), None)
+
+    for size in UPLOAD_SIZES:
+        for fmt in ["JPEG", "PNG"]:
+            data = make_upload(size, fmt)
+            cases[f"process_bg/{fmt}/{size[0]}x{size[1]}"] = (
+                lambda data=data: process_bg(io.BytesIO(data), SIZE), None)
+
+    max_width = SIZE[0] - 100
+    for font_name, font_path in FONT_FILES.items():
+        body_font = get_font(font_path, OVERLAY_FONT_SIZES["body"])
+        for kind, ad in ads.items():
+            cases[f"wrap_text_by_width/{font_name}/{kind}"] = (
+                lambda ad=ad, font=body_font: wrap_text_by_width(ad["text"], font, max_width), None)
+
+            blocks = [(ad["headline"], True), (ad["text"], False), (ad["call_to_action"], False)]
+            cases[f"get_fitting_font_size/{font_name}/{kind}"] = (
+                lambda blocks=blocks, font_path=font_path: get_fitting_font_size(blocks, font_path, max_width, 600),
+                text_layout.block_cache.clear)
+
+            background = gen_solid_bg("#FFFFFF", SIZE)
+            for autofit in [False, True]:
+                label = "autofit" if autofit else "fixed"
+                def draw(ad=ad, font_path=font_path, background=background, autofit=autofit):
+                    return overlay_txt(ad, background.copy(), "#000000", font_path, autofit=autofit)
+                cases[f"overlay_txt/{font_name}/{kind}/{label}/cold"] = (draw, clear_layout_caches)
+                cases[f"overlay_txt/{font_name}/{kind}/{label}/warm"] = (draw, None)
+
+    rendered = overlay_txt(ads["long"], gen_grad_bg("#FFEEDD", "#3366CC", "Diagonal", SIZE), "#000000",
+                           FONT_FILES["Arial"])
+    for level in [6, 1]:
+        def encode(level=level):
+            rendered.save(io.BytesIO(), format="PNG", compress_level=level)
+        cases[f"png_encode/compress_level={level}"] = (encode, None)
+    for name, settings in {"preview": image_encode.PREVIEW, **image_encode.FORMATS}.items():
+        cases[f"encode_image/{name}"] = (lambda settings=settings: image_encode.encode_image(rendered, **settings), None)
+
+    # Every platform format in one pass (backgrounds cached, text layers/encodes not)
+    def background(size):
+        return image_gen.get_bg("Gradient", ("#FFEEDD", "#3366CC"), "Diagonal", size)
+    for platform_name in image_gen.PLATFORM_FORMATS:
+        formats = image_gen.platform_formats(platform_name)
+        cases[f"render_formats/{platform_name}"] = (
+            lambda formats=formats: image_gen.render_formats(ads["long"], background, "#000000",
+                                                             FONT_FILES["Arial"], formats),
+            clear_render_caches)
+    cases["render_bundle/Instagram/PNG"] = (
+        lambda: image_encode.render_bundle(ads["long"], background, "#000000", FONT_FILES["Arial"],
+                                           image_gen.platform_formats("Instagram")),
+        clear_render_caches)
+
+    # A restyle as the app shows it: the instant preview (full-size layout cached, drawn
+    # at preview size) against the full-resolution render, both with a new text color
+    small_background = background(image_gen.preview_size(SIZE))
+    cases["restyle/preview"] = (
+        lambda: image_encode.encode_image(image_gen.render_preview(
+            ads["long"], small_background, "#336699", FONT_FILES["Arial"], SIZE, True), **image_encode.PREVIEW),
+        None)
+    cases["restyle/full"] = (
+        lambda: image_encode.encode_image(image_gen.overlay_txt_layer(
+            ads["long"], background(SIZE), "#336699", FONT_FILES["Arial"], True), **image_encode.PREVIEW),
+        image_gen.layer_cache.clear)
+
+    # A preview as the app shows it on a rerun: from memory, and from the disk store
+    # once the in-memory tier has let it go
+    preview_args = (ads["long"], background(SIZE), "#000000", FONT_FILES["Arial"])
+    preview_key = image_encode.store_render(*preview_args)
+    cases["load_render/memory"] = (lambda: image_encode.load_render(preview_key), None)
+    cases["load_render/disk"] = (
+        lambda: image_encode.load_render(preview_key),
+        lambda: image_encode.encoded_cache.pop(preview_key) or image_encode.store_render(*preview_args))
+
+    # Chain assembly against a fake model: building everything from scratch
+    # (prompt, parser, few-shot index, chain) and one invoke through the chain
+    responses = [json.dumps(ad) for ad in ads.values()]
+    fake_model = FakeListChatModel(responses=responses)
+    ad_chain.get_model = lambda: fake_model
+    scheduler = ad_chain.GeminiScheduler()  # no quota limits for the fake model
+    ad_chain.get_scheduler = lambda: scheduler
+    input_data = {k: v for k, v in ad_chain.load_few_shot_examples()[0].items() if k != "ad_output_json"}
+    cases["setup_llm_chain/cold"] = (lambda: ad_chain.setup_llm_chain(0.7), clear_chain_caches)
+    cases["setup_llm_chain/invoke_fake_model"] = (lambda: ad_chain.setup_llm_chain(0.7).invoke(input_data), None)
+    return cases
+
+
+# Import cost, measured in a fresh interpreter with -X importtime. app_startup is
+# what app.py imports before the first paint; the LLM stack (ad_chain) is loaded
+# lazily and must stay out of it.
+IMPORT_CASES = {
+    "import/app_startup": "streamlit, streamlit_tags, image_gen, image_encode, tracing",
+    "import/ad_chain": "ad_chain",
+    "import/image_gen": "image_gen",
+}
+
+# Parses -X importtime output into (total microseconds, {module: self microseconds})
+def parse_importtime(stderr):
+    total, self_times = 0, {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        self_times[name.strip()] = int(self_us)
+        if not name.startswith("  "):  # top-level import
+            total += int(cumulative_us)
+    return total, self_times
+
+def time_import(statement, repeat):
+    totals, self_times = [], {}
+    for _ in range(repeat + 1):  # the first run warms the OS file cache
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {statement}"],
+                              capture_output=True, text=True, cwd=REPO_DIR)
+        if proc.returncode != 0:
+            raise RuntimeError(f"import {statement} failed:\n{proc.stderr[-2000:]}")
+        total, self_times = parse_importtime(proc.stderr)
+        totals.append(total / 1000)
+    totals = totals[1:]
+    result = {
+        "median_ms": round(statistics.median(totals), 4),
+        "min_ms": round(min(totals), 4),
+        "runs": repeat,
+    }
+    return result, self_times
+
+def print_heaviest_imports(self_times, count=10):
+    heaviest = sorted(self_times.items(), key=lambda item: -item[1])[:count]
+    for name, us in heaviest:
+        print(f"    {us / 1000:8.1f}ms  {name.strip()}")
+
+
+def time_case(fn, setup, repeat):
+    setup and setup()
+    fn()  # warm-up: imports, lazy initialization
+    times = []
+    for _ in range(repeat):
+        setup and setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_ms": round(statistics.median(times) * 1000, 4),
+        "min_ms": round(min(times) * 1000, 4),
+        "runs": repeat,
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=BENCH_DIR).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pillow": PIL.__version__,
+        "numpy": np.__version__,
+    }
+
+# Returns the names of the regressed cases and prints a comparison table
+def compare(results, baseline, threshold, min_delta_ms):
+    regressions = []
+    print(f"\n{'case':<52} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<52} {'-':>10} {result['median_ms']:>9.2f}ms {'new':>8}")
+            continue
+        change = result["median_ms"] / base["median_ms"] - 1 if base["median_ms"] else 0.0
+        regressed = change > threshold and result["median_ms"] - base["median_ms"] > min_delta_ms
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<52} {base['median_ms']:>9.2f}ms {result['median_ms']:>9.2f}ms {change:>+7.0%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the rendering/chain benchmarks and compare with a baseline.")
+    parser.add_argument("-k", "--filter", default="", help="Only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case (the median is reported)")
+    parser.add_argument("--out", default=DEFAULT_OUT, help="Where to write this run's results")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed slowdown vs the baseline (0.25 = 25%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5, help="Ignore slowdowns smaller than this")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, statement in IMPORT_CASES.items():
+        if args.filter in name:
+            results[name], self_times = time_import(statement, args.repeat)
+            print(f"{name:<52} {results[name]['median_ms']:>9.2f}ms (min {results[name]['min_ms']:.2f}ms)")
+            if name == "import/app_startup":
+                if any(module.strip().startswith("langchain") for module in self_times):
+                    print("    warning: the app's start-up imports load LangChain")
+                print_heaviest_imports(self_times)
+
+    cases = {name: case for name, case in build_cases().items() if args.filter in name}
+    for name, (fn, setup) in cases.items():
+        results[name] = time_case(fn, setup, args.repeat)
+        print(f"{name:<52} {results[name]['median_ms']:>9.2f}ms (min {results[name]['min_ms']:.2f}ms)")
+
+    report = {"environment": environment(), "results": results}
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nresults written to {args.out}")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)["results"]
+        report = {"environment": report["environment"], "results": {**baseline, **results}}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"baseline from {baseline['environment'].get('timestamp')} "
+          f"(commit {baseline['environment'].get('commit') or '?'}, {baseline['environment'].get('platform')})")
+    regressions = compare(results, baseline["results"], args.threshold, args.min_delta_ms)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}: " + ", ".join(regressions))
+        return 1
+    print(f"\nno regressions over {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+# Headless bulk rendering: a CSV/JSONL of campaign rows in, one PNG per row out.
+#
+#   python bulk_render.py campaigns.csv out/ --concurrency 16 --workers 4
+#
+# Each row holds the same fields as the app form (company_name, product_name,
+# product_description, platform, cta, phone, email, website, location and optionally
+# audience, tone, campaign_goal, keywords_to_include, word_limit, include_hashtags,
+# temperature) plus optional styling columns: id, font, text_color, bg_style
+# (Solid/Gradient/Image), bg_color, grad_start, grad_end, direction, bg_image.
+#
+# Ads are generated concurrently (I/O bound) and rendered/encoded in a process pool
+# (CPU bound). Generated ads are appended to out/ads.jsonl and rows whose image
+# already exists are skipped, so an interrupted run can simply be restarted.
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+from PIL import ImageColor
+
+from image_gen import FONT_FILES
+
+
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    for i, row in enumerate(rows):
+        row["id"] = str(i if is_blank(row.get("id")) else row["id"])
+    return rows
+
+# Empty CSV cells and missing JSONL keys both mean "use the default"; 0 and False don't
+def is_blank(value):
+    return value is None or value == ""
+
+# Same defaults as the Streamlit form. Only called where ads are generated, so the
+# render workers never import the LLM stack.
+def row_to_input(row):
+    from ad_chain import parse_flag, word_limit_of
+    word_limit = word_limit_of(row)  # 50, "50" or "50 words"
+    return {
+        "company_name": row.get("company_name", ""),
+        "product_name": row.get("product_name", ""),
+        "product_description": row.get("product_description", ""),
+        "platform": row.get("platform", ""),
+        "audience": row.get("audience") or "Everyone",
+        "tone": row.get("tone") or "Exciting",
+        "cta": row.get("cta", ""),
+        "phone": row.get("phone") or "",
+        "email": row.get("email") or "",
+        "website": row.get("website") or "",
+        "location": row.get("location") or "",
+        "campaign_goal": row.get("campaign_goal") or "Increase awareness",
+        "keywords_to_include": row.get("keywords_to_include") or "",
+        "word_limit": 50 if word_limit is None else word_limit,
+        "include_hashtags": True if is_blank(row.get("include_hashtags")) else parse_flag(row["include_hashtags"]),
+    }
+
+def row_to_style(row):
+    font = row.get("font") or "Arial"
+    bg_style = row.get("bg_style") or "Solid"
+    if bg_style == "Gradient":
+        bg = ("Gradient", (row.get("grad_start") or "#FFFFFF", row.get("grad_end") or "#FFFFFF"),
+              row.get("direction") or "Vertical", None)
+    elif bg_style == "Image":
+        if is_blank(row.get("bg_image")):
+            raise ValueError("bg_style Image needs a bg_image path")
+        bg = ("Image", (), None, row["bg_image"])
+    else:
+        bg = ("Solid", (row.get("bg_color") or "#FFFFFF",), None, None)
+    text_color = row.get("text_color") or "#000000"
+    for color in (text_color, *bg[1]):
+        ImageColor.getrgb(color)  # ValueError for anything that isn't a color
+    return {
+        "font_path": FONT_FILES.get(font, font),
+        "text_color": text_color,
+        "bg": bg,
+    }
+
+def load_done_ads(path):
+    ads = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    ads[record["id"]] = record["ad"]
+    return ads
+
+
+# Worker process side
+
+# Image backgrounds are keyed by path and modification time, so a file used by many
+# rows is read and decoded once per worker instead of being hashed for every row
+def get_worker_bg(bg):
+    from image_gen import bg_cache, get_bg, process_bg
+    style, colors, direction, image_path = bg
+    if style == "Image":
+        key = ("File", os.path.abspath(image_path), os.stat(image_path).st_mtime_ns, (1080, 1080))
+        return bg_cache.get_or_create(key, lambda: process_bg(image_path))
+    return get_bg(style, colors, direction)
+
+# Runs once per worker: loads every font face and the backgrounds shared by several rows
+def init_worker(font_paths, backgrounds):
+    from image_gen import warm_fonts
+    warm_fonts(font_paths)
+    for bg in backgrounds:
+        try:
+            get_worker_bg(bg)
+        except Exception:
+            pass  # reported per row when it is rendered; raising here would break the pool
+
+def render_row(ad, style, out_path):
+    from image_gen import overlay_txt_layer
+    start = time.perf_counter()
+    bg = get_worker_bg(style["bg"])
+    img = overlay_txt_layer(ad, bg, style["text_color"], style["font_path"], autofit=True)
+    rendered = time.perf_counter()
+    tmp_path = out_path + ".tmp"
+    img.save(tmp_path, format="PNG")
+    os.replace(tmp_path, out_path)  # a crash never leaves a half-written image behind
+    return rendered - start, time.perf_counter() - rendered
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate and render ads for every row of a CSV/JSONL file.")
+    parser.add_argument("rows", help="CSV or JSONL file of campaign rows")
+    parser.add_argument("out_dir", help="Directory for the rendered images and ads.jsonl")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent Gemini calls")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Render processes")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds per attempt at an ad (generation plus any repair calls)")
+    parser.add_argument("--retries", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    ads_path = os.path.join(args.out_dir, "ads.jsonl")
+    rows = read_rows(args.rows)
+    done_ads = load_done_ads(ads_path)
+
+    def out_path(row):
+        return os.path.join(args.out_dir, f"{row['id']}.png")
+
+    # A row with bad styling fails on its own instead of stopping the run
+    failures = generated = 0
+    styles = {}
+    pending = [row for row in rows if not os.path.exists(out_path(row))]
+    for row in pending:
+        try:
+            styles[row["id"]] = row_to_style(row)
+        except ValueError as e:
+            failures += 1
+            print(f"[{row['id']}] bad styling: {e}", file=sys.stderr)
+    todo = [row for row in pending if row["id"] in styles]
+    to_generate = [row for row in todo if row["id"] not in done_ads]
+    print(f"{len(rows)} rows: {len(rows) - len(pending)} already rendered, {failures} with bad styling, "
+          f"{len(todo) - len(to_generate)} ads already generated, {len(to_generate)} to generate")
+    if not todo:
+        return 1 if failures else 0
+
+    # A background used by a single row is only decoded by the worker that renders it
+    uses = Counter(style["bg"] for style in styles.values())
+    backgrounds = [bg for bg, count in uses.items() if count > 1]
+    render_times, encode_times = [], []
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(list(FONT_FILES.values()), backgrounds)) as pool:
+        renders = {}
+
+        def submit(row, ad):
+            renders[pool.submit(render_row, ad, styles[row["id"]], out_path(row))] = row["id"]
+
+        for row in todo:
+            if row["id"] in done_ads:
+                submit(row, done_ads[row["id"]])
+
+        # Rendering starts as soon as each ad arrives instead of after the whole batch
+        generate_start = time.perf_counter()
+        if to_generate:
+            load_dotenv()
+            if not os.environ.get("GOOGLE_API_KEY"):
+                print("GOOGLE_API_KEY is not set (environment or .env)", file=sys.stderr)
+                return 2
+            from ad_chain import generate_ads_batch
+            temps = {row["id"]: float(args.temperature if is_blank(row.get("temperature")) else row["temperature"])
+                     for row in to_generate}
+            with open(ads_path, "a", encoding="utf-8") as ads_file:
+                for temp in sorted(set(temps.values())):
+                    batch = [row for row in to_generate if temps[row["id"]] == temp]
+                    results = generate_ads_batch([row_to_input(row) for row in batch], temp,
+                                                 concurrency=args.concurrency, timeout=args.timeout,
+                                                 retries=args.retries)
+                    for result in results:
+                        row = batch[result.index]
+                        if result.error is not None:
+                            failures += 1
+                            print(f"[{row['id']}] generation failed: {result.error!r}", file=sys.stderr)
+                            continue
+                        ads_file.write(json.dumps({"id": row["id"], "ad": result.ad}) + "\n")
+                        ads_file.flush()
+                        generated += 1
+                        submit(row, result.ad)
+        generate_time = time.perf_counter() - generate_start
+
+        for future in as_completed(renders):
+            try:
+                render_time, encode_time = future.result()
+                render_times.append(render_time)
+                encode_times.append(encode_time)
+            except Exception as e:
+                failures += 1
+                print(f"[{renders[future]}] render failed: {e!r}", file=sys.stderr)
+    total_time = time.perf_counter() - start
+
+    def rate(count, seconds):
+        return f"{count / seconds:.2f}/s" if seconds > 0 else "-"
+
+    print(f"generate: {generated} ads in {generate_time:.1f}s ({rate(generated, generate_time)})")
+    print(f"render:   {len(render_times)} images, {sum(render_times):.1f} worker-s "
+          f"({rate(len(render_times), sum(render_times))} per worker)")
+    print(f"encode:   {len(encode_times)} PNGs, {sum(encode_times):.1f} worker-s "
+          f"({rate(len(encode_times), sum(encode_times))} per worker)")
+    print(f"total:    {len(render_times)} images in {total_time:.1f}s ({rate(len(render_times), total_time)}), "
+          f"{failures} failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+
+# Thread-safe LRU cache bounded by entry count and/or total size in bytes.
+# Streamlit runs every session in its own thread, so caches that live at
+# module level are shared by all sessions of the process.
+class LRUCache:
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            # Values bigger than the whole budget are simply not cached
+            if self.max_bytes is not None and size > self.max_bytes:
+                return value
+            self._data[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+        return value
+
+    def get_or_create(self, key, factory):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            # Built outside the lock so slow factories don't block other sessions
+            value = self.put(key, factory())
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, size = self._data.pop(key)
+            self.nbytes -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _evict(self):
+        while self._data and (
+            (self.max_items is not None and len(self._data) > self.max_items)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            _, (_, size) = self._data.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+
+_MISSING = object()
@@ -0,0 +1,89 @@
+import math
+import re
+from collections import Counter
+
+from langchain_core.example_selectors import BaseExampleSelector
+
+
+# Input fields that describe what an ad is about, with their weight in the match
+MATCH_FIELDS = {"product_description": 1.0, "audience": 0.7, "tone": 0.5, "platform": 0.3}
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it",
+    "of", "on", "or", "our", "the", "to", "with", "your", "you", "we", "that", "this",
+}
+
+
+def tokenize(text):
+    return [word for word in re.findall(r"\w+", str(text or "").lower()) if word not in STOP_WORDS]
+
+# Rough token count (~4 characters per token), good enough for budgeting prompts
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+# Picks the few-shot examples most similar to the request, using an offline TF-IDF
+# index over the examples' description, audience, tone and platform. Examples are
+# taken in order of relevance, up to k of them and only while their rendered size
+# (cost(example) tokens) fits the token budget. k=None and token_budget=None select
+# every example.
+class RelevantExampleSelector(BaseExampleSelector):
+
+    def __init__(self, examples, k=2, token_budget=800, cost=None):
+        self.k = k
+        self.token_budget = token_budget
+        self.cost = cost or (lambda example: estimate_tokens(str(example)))
+        self.examples = []
+        self._build_index(examples)
+
+    def add_example(self, example):
+        self._build_index(self.examples + [example])
+
+    def select_examples(self, input_variables):
+        query = self._vectorize(input_variables)
+        ranked = sorted(
+            range(len(self.examples)),
+            key=lambda i: (-self._similarity(query, self._vectors[i]), i),
+        )
+        selected, used = [], 0
+        for i in ranked:
+            if self.k is not None and len(selected) >= self.k:
+                break
+            if self.token_budget is not None and used + self._costs[i] > self.token_budget:
+                continue
+            selected.append(i)
+            used += self._costs[i]
+        # Keep the library order so the prompt is stable for a given selection
+        return [self.examples[i] for i in sorted(selected)]
+
+    def _build_index(self, examples):
+        self.examples = list(examples)
+        self._costs = [self.cost(example) for example in self.examples]
+        terms = [self._terms(example) for example in self.examples]
+        doc_freq = Counter(term for example_terms in terms for term in set(example_terms))
+        count = len(self.examples)
+        self._idf = {term: math.log((1 + count) / (1 + df)) + 1 for term, df in doc_freq.items()}
+        self._vectors = [self._weigh(example_terms) for example_terms in terms]
+
+    # Term frequencies with the field weights applied, terms prefixed by field so
+    # e.g. "instagram" in the platform doesn't match a description word
+    def _terms(self, example):
+        terms = Counter()
+        for field, weight in MATCH_FIELDS.items():
+            for word in tokenize(example.get(field)):
+                terms[f"{field}:{word}"] += weight
+        return terms
+
+    def _weigh(self, terms):
+        vector = {term: tf * self._idf.get(term, 0.0) for term, tf in terms.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values()))
+        return {term: w / norm for term, w in vector.items()} if norm else {}
+
+    def _vectorize(self, input_variables):
+        return self._weigh(self._terms(input_variables))
+
+    @staticmethod
+    def _similarity(a, b):
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(w * b.get(term, 0.0) for term, w in a.items())
@@ -0,0 +1,123 @@
+import hashlib
+import io
+import json
+import weakref
+import zipfile
+
+from PIL import ImageColor
+
+from artifact_store import get_artifact_store
+from cache import LRUCache
+from image_gen import ad_hash, overlay_txt_layer, render_preview, map_concurrently
+from tracing import span
+
+
+# Encoder settings for downloads, by the name shown in the app. PNG is lossless
+# (compress_level trades size for speed, 0-9); JPEG keeps full chroma resolution
+# so colored text stays sharp.
+FORMATS = {
+    "PNG": {"format": "PNG", "compress_level": 6},
+    "JPEG": {"format": "JPEG", "quality": 92, "optimize": True, "progressive": True, "subsampling": 0},
+    "WebP": {"format": "WEBP", "quality": 90, "method": 4},
+}
+
+# On-screen preview: ~10x faster to encode than the PNG download and smaller to send
+PREVIEW = {"format": "JPEG", "quality": 85, "subsampling": 0}
+
+MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+
+
+def encode_image(img, format="PNG", **options):
+    buffer = io.BytesIO()
+    with span("encode"):
+        if format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+# PIL images aren't hashable, so digests are kept by id and dropped with the image
+_digests = {}
+
+# Content hash of an image's pixels. Backgrounds come shared from image_gen's
+# caches, so each one is hashed once.
+def image_digest(img):
+    digest = _digests.get(id(img))
+    if digest is None:
+        digest = _digests[id(img)] = hashlib.sha256(
+            f"{img.mode}{img.size}".encode() + img.tobytes()).hexdigest()
+        weakref.finalize(img, _digests.pop, id(img), None)
+    return digest
+
+# Address of an encoded render: a hash of everything that determines its bytes.
+# full_size is set for previews laid out at that size (see render_preview).
+def render_digest(ad, background, fill, font_path, autofit=False, settings=PREVIEW, reduce=1, full_size=None):
+    fill = ImageColor.getrgb(fill)[:3] if isinstance(fill, str) else tuple(fill)[:3]
+    parts = [ad_hash(ad), image_digest(background), fill, font_path, autofit, sorted(settings.items()), reduce,
+             full_size and tuple(full_size)]
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+# Hot encoded renders shared by all reruns and sessions, bounded to ~32 MB, in front
+# of the disk artifact store that holds every encoded render by its digest. Entries
+# are immutable bytes, so callers can hold on to them.
+encoded_cache = LRUCache(max_bytes=32 * 1024 * 1024, sizeof=len)
+
+# Renders (text layer over the background) and encodes with the given settings into
+# the artifact store and returns the render's key, or just the key of an identical
+# earlier render. reduce > 1 shrinks the image by that factor first, e.g. for thumbnails.
+def store_render(ad, background, fill, font_path, autofit=False, settings=PREVIEW, reduce=1):
+    key = render_digest(ad, background, fill, font_path, autofit, settings, reduce)
+    if key not in encoded_cache and key not in get_artifact_store():
+        encode_render(ad, background, fill, font_path, autofit, settings, reduce)
+    return key
+
+# Same as store_render, but returns the encoded bytes
+def encode_render(ad, background, fill, font_path, autofit=False, settings=PREVIEW, reduce=1):
+    def render_and_encode():
+        img = overlay_txt_layer(ad, background, fill, font_path, autofit)
+        if reduce > 1:
+            img = img.reduce(reduce)
+        return encode_image(img, **settings)
+    key = render_digest(ad, background, fill, font_path, autofit, settings, reduce)
+    return encoded_cache.get_or_create(key, lambda: get_artifact_store().get_or_create(key, render_and_encode))
+
+# Instant preview (image_gen.render_preview) of the full_size render, over a
+# background at the preview size, encoded into the shared store like store_render.
+# Returns the preview's key.
+def store_preview(ad, background, fill, font_path, full_size=(1080, 1080), autofit=False):
+    key = render_digest(ad, background, fill, font_path, autofit, full_size=full_size)
+    if key not in encoded_cache and key not in get_artifact_store():
+        encode_preview(ad, background, fill, font_path, full_size, autofit)
+    return key
+
+def encode_preview(ad, background, fill, font_path, full_size=(1080, 1080), autofit=False):
+    def render_and_encode():
+        return encode_image(render_preview(ad, background, fill, font_path, full_size, autofit), **PREVIEW)
+    key = render_digest(ad, background, fill, font_path, autofit, full_size=full_size)
+    return encoded_cache.get_or_create(key, lambda: get_artifact_store().get_or_create(key, render_and_encode))
+
+# Encoded bytes of a stored render, or None once it has been evicted
+def load_render(key):
+    data = encoded_cache.get(key)
+    return data if data is not None else get_artifact_store().get(key)
+
+# Every format of an ad, rendered and encoded concurrently (each through the shared
+# encoded store), as a zip archive of <prefix>_<name>_<width>x<height>.<ext> files.
+# background(size) gives the background at each native size, as for render_formats.
+def render_bundle(ad, background, fill, font_path, formats, settings=FORMATS["PNG"], autofit=True,
+                  prefix="ad", max_workers=None):
+    def encode_one(fmt):
+        name, size = fmt
+        size = tuple(size)
+        return name, size, encode_render(ad, background(size), fill, font_path, autofit, settings)
+
+    extension = EXTENSIONS[settings["format"]]
+    archive = io.BytesIO()
+    # Images are already compressed; storing them keeps zipping free
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as bundle:
+        for name, (width, height), data in map_concurrently(encode_one, formats, max_workers):
+            bundle.writestr(f"{prefix}_{name}_{width}x{height}.{extension}", data)
+    return archive.getvalue()
+
@@ -1,102 +1,257 @@
-from PIL import Image, ImageDraw, ImageFont, ImageColor
+from PIL import Image, ImageDraw, ImageFont, ImageColor, ImageOps
 import textwrap
+import contextvars
+import hashlib
+import io
+import json
+import math
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
+from artifact_store import get_artifact_store
+from cache import LRUCache
+from text_layout import wrap_lines, layout_block, draw_block
+from tracing import span
+
+# Scales the image so it covers the frame (down or up) and crops the center, in a
+# single resize over just the region that ends up in the output
 def center_crop(image, size=(1080, 1080)):
     width, height = image.size
     new_width, new_height = size
-    if width < new_width or height < new_height:
-        scale = max(new_width / width, new_height / height)
-        image = image.resize((int(width * scale), int(height * scale)), Image.ANTIALIAS)
-        width, height = image.size
-    left = (width - new_width) / 2
-    top = (height - new_height) / 2
-    return image.crop((left, top, left + new_width, top + new_height))
-
-def gen_solid_bg(color):
+    scale = max(new_width / width, new_height / height)
+    box_width, box_height = new_width / scale, new_height / scale
+    left = (width - box_width) / 2
+    top = (height - box_height) / 2
+    box = (left, top, left + box_width, top + box_height)
+    if image.mode in ("P", "1"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    # reducing_gap lets Pillow box-reduce large images before the LANCZOS pass
+    return image.resize(size, Image.Resampling.LANCZOS, box=box, reducing_gap=3.0)
+
+EXIF_ORIENTATION = 0x0112
+
+# Opens an upload for a size-sized background. JPEGs are decoded directly at the
+# smallest DCT scale (1/2, 1/4, 1/8) that still covers the frame, and EXIF
+# orientation is applied before cropping.
+def open_bg(src, size=(1080, 1080)):
+    img = Image.open(src)
+    if img.format == "JPEG":
+        target_width, target_height = size
+        if img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            target_width, target_height = target_height, target_width
+        width, height = img.size
+        scale = max(target_width / width, target_height / height)
+        if scale < 1:
+            img.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    return ImageOps.exif_transpose(img)
+
+# Crops an (H, W, C) array to the frame's aspect ratio with a slice view, so only
+# the pixels that end up in the background are handed to PIL
+def array_to_bg(array, size=(1080, 1080)):
+    height, width = array.shape[:2]
+    scale = max(size[0] / width, size[1] / height)
+    crop_width = min(width, math.ceil(size[0] / scale))
+    crop_height = min(height, math.ceil(size[1] / scale))
+    top, left = (height - crop_height) // 2, (width - crop_width) // 2
+    return Image.fromarray(np.ascontiguousarray(array[top:top + crop_height, left:left + crop_width]))
+
+def gen_solid_bg(color, size=(1080, 1080)):
     color = ImageColor.getrgb(color)
-    return Image.new("RGB", (1080, 1080), color)
-
-def gen_grad_bg(start_color, end_color, direction):
-    start_color = ImageColor.getrgb(start_color)
-    end_color = ImageColor.getrgb(end_color)
-    img = Image.new("RGB", (1080, 1080))
-    draw = ImageDraw.Draw(img)
-    for y in range(1080):
-        for x in range(1080):
-            ratio = {
-                "Vertical": y / 1080,
-                "Horizontal": x / 1080,
-                "Diagonal": (x + y) / (2 * 1080)
-            }.get(direction, 0)
-            r = int(start_color[0] * (1 - ratio) + end_color[0] * ratio)
-            g = int(start_color[1] * (1 - ratio) + end_color[1] * ratio)
-            b = int(start_color[2] * (1 - ratio) + end_color[2] * ratio)
-            draw.point((x, y), fill=(r, g, b))
-    return img
-
-def process_bg(img):
+    return Image.new("RGB", size, color)
+
+# Interpolation ratio in [0, 1] for each gradient direction, as an array that
+# broadcasts to (height, width) so linear gradients only compute one row/column
+def grad_ratio(size, direction, angle=0):
+    width, height = size
+    x = np.arange(width, dtype=np.float64)[None, :]
+    y = np.arange(height, dtype=np.float64)[:, None]
+    if direction == "Vertical":
+        return y / height
+    if direction == "Horizontal":
+        return x / width
+    if direction == "Diagonal":
+        return (x * height + y * width) / (2 * width * height)
+    if direction == "Radial":
+        # 0 at the center, 1 at the corners
+        dist = np.hypot(x - (width - 1) / 2, y - (height - 1) / 2)
+        return dist / max(dist.max(), 1)
+    if direction == "Angle":
+        # Project onto a unit vector (0 deg = left to right, 90 deg = top to bottom)
+        theta = np.deg2rad(angle)
+        proj = x * np.cos(theta) + y * np.sin(theta)
+        lo, hi = proj.min(), proj.max()
+        return (proj - lo) / (hi - lo) if hi > lo else np.zeros((1, 1))
+    return np.zeros((1, 1))
+
+def gen_multi_grad_bg(colors, direction="Vertical", size=(1080, 1080), stops=None, angle=0):
+    colors = np.array([ImageColor.getrgb(c)[:3] for c in colors], dtype=np.float64)
+    if stops is None:
+        stops = np.linspace(0, 1, len(colors))
+    ratio = grad_ratio(size, direction, angle)
+    if len(colors) == 2 and stops[0] == 0 and stops[-1] == 1:
+        # Same blend (and truncation) as the original per-pixel loop
+        ratio = ratio[..., None]
+        rgb = colors[0] * (1 - ratio) + colors[1] * ratio
+    else:
+        rgb = np.stack([np.interp(ratio, stops, colors[:, c]) for c in range(3)], axis=-1)
+    rgb = np.broadcast_to(rgb.astype(np.uint8), (size[1], size[0], 3))
+    return Image.fromarray(np.ascontiguousarray(rgb))
+
+def gen_grad_bg(start_color, end_color, direction, size=(1080, 1080), angle=0):
+    return gen_multi_grad_bg([start_color, end_color], direction, size, angle=angle)
+
+def process_bg(img, size=(1080, 1080)):
     if isinstance(img, np.ndarray):
-        img = Image.fromarray(img)
+        img = array_to_bg(img, size)
     elif not isinstance(img, Image.Image):
-        img = Image.open(img)
-    return center_crop(img).convert("RGB")
+        img = open_bg(img, size)
+    return center_crop(img, size).convert("RGB")
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+# Backgrounds shared across reruns and sessions, bounded to ~200 MB (about 60 RGB 1080x1080 images)
+bg_cache = LRUCache(max_bytes=200 * 1024 * 1024, sizeof=image_nbytes)
+
+def upload_digest(upload):
+    data = upload.getvalue() if hasattr(upload, "getvalue") else upload.read()
+    if hasattr(upload, "seek"):
+        upload.seek(0)
+    return hashlib.sha256(data).hexdigest(), data
+
+# Cached background lookup. Solid/Gradient are keyed by (style, colors, direction, size),
+# uploads by a content hash of the file. An upload already in the artifact store can be
+# passed by its key (the same hash) instead, and is only read if the background isn't
+# cached. The returned image is shared, so copy it before drawing.
+def get_bg(style, colors=(), direction=None, size=(1080, 1080), upload=None, upload_key=None):
+    with span("background"):
+        size = tuple(size)
+        if style == "Image":
+            if upload_key is None:
+                upload_key, data = upload_digest(upload)
+                load = lambda: data
+            else:
+                load = lambda: get_artifact_store().get(upload_key)
+            return bg_cache.get_or_create(("Image", upload_key, size), lambda: process_bg(io.BytesIO(load()), size))
+        key = (style, tuple(colors), direction, size)
+        if style == "Gradient":
+            return bg_cache.get_or_create(key, lambda: gen_multi_grad_bg(colors, direction, size))
+        return bg_cache.get_or_create(key, lambda: gen_solid_bg(colors[0], size))
+
+# Bundled fonts by the name shown in the app
+FONT_FILES = {
+    "Arial": "fonts/OpenSans-VariableFont_wdth,wght.ttf",
+    "Georgia": "fonts/LibreBaskerville-Regular.ttf",
+    "Montserrat": "fonts/Montserrat-Italic-VariableFont_wght.ttf",
+    "Pacifico": "fonts/Pacifico-Regular.ttf",
+    "Anton": "fonts/Anton-Regular.ttf"
+}
+
+# Font sizes used by overlay_txt for each section
+OVERLAY_FONT_SIZES = {"company": 50, "headline": 70, "body": 45, "small": 40, "contact": 28}
+
+font_cache = LRUCache(max_items=512)
+
+# Shared FreeType fonts keyed by (path, size, variation axes). Opened by path, so
+# FreeType reads the file itself instead of each size holding its own copy of the
+# font bytes; variable fonts get one object per axes setting since
+# set_variation_by_axes changes the face in place.
+def get_font(path, size, axes=None):
+    axes = tuple(axes) if axes else None
+    def load():
+        with span("font_load"):
+            font = ImageFont.truetype(path, size)
+            if axes:
+                font.set_variation_by_axes(list(axes))
+            return font
+    return font_cache.get_or_create((path, size, axes), load)
+
+def warm_fonts(paths, sizes=tuple(OVERLAY_FONT_SIZES.values())):
+    for path in paths:
+        for size in sizes:
+            get_font(path, size)
 
 def wrap_text_by_width(text, font, max_pixel_width):
-    words = text.split()
-    lines, line = [], ""
-    for word in words:
-        test_line = f"{line} {word}".strip()
-        if font.getlength(test_line) <= max_pixel_width:
-            line = test_line
-        else:
-            if line:
-                lines.append(line)
-            line = word
-    if line:
-        lines.append(line)
-    return lines
+    return wrap_lines(text, font, max_pixel_width)
 
 def measure_block_height(text, font, max_pixel_width, line_spacing=15, block_spacing=30):
-    if not text:
-        return 0
-    lines = wrap_text_by_width(text, font, max_pixel_width)
-    return sum(font.getbbox(line)[3] - font.getbbox(line)[1] + line_spacing for line in lines) - line_spacing + block_spacing
+    return layout_block(text, font, max_pixel_width, line_spacing, block_spacing).height
 
 def draw_text_block(draw, text, font, max_pixel_width, y_offset, img_width, margin=50, fill=(0, 0, 0), center_align=False, line_spacing=15, block_spacing=30):
-    if not text:
-        return y_offset
-    lines = wrap_text_by_width(text, font, max_pixel_width)
-    for line in lines:
-        line_width = font.getlength(line)
-        x = (img_width - line_width) // 2 if center_align else margin
-        draw.text((x, y_offset), line, font=font, fill=fill)
-        y_offset += font.getbbox(line)[3] - font.getbbox(line)[1] + line_spacing
-    return y_offset + block_spacing
+    block = layout_block(text, font, max_pixel_width, line_spacing, block_spacing)
+    return draw_block(draw, block, font, y_offset, img_width, margin, fill, center_align)
 
+# Largest size in range(max_font_size, min_font_size - 1, -step) whose blocks fit
+# max_height. Total height grows with the font size, so the candidates are binary
+# searched instead of scanned.
 def get_fitting_font_size(text_blocks, font_path, max_width, max_height, max_font_size=60, min_font_size=20, step=2, line_spacing=15, block_spacing=30):
-    for size in range(max_font_size, min_font_size - 1, -step):
+    def fits(size):
         total_height = 0
         for text, is_subhead in text_blocks:
-            font = ImageFont.truetype(font_path, size if not is_subhead else int(size * 1.2))
-            lines = wrap_text_by_width(text, font, max_width)
-            if not lines:
+            font = get_font(font_path, size if not is_subhead else int(size * 1.2))
+            block = layout_block(text, font, max_width, line_spacing, block_spacing)
+            if not block.lines:
                 continue
-            block_height = sum(font.getbbox(line)[3] - font.getbbox(line)[1] + line_spacing for line in lines) - line_spacing + block_spacing
-            total_height += block_height
-        if total_height <= max_height:
-            return size
-    return min_font_size
+            total_height += block.height
+        return total_height <= max_height
+
+    sizes = list(range(max_font_size, min_font_size - 1, -step))[::-1]
+    index, probes = largest_fitting(len(sizes), lambda i: fits(sizes[i]))
+    return sizes[index] if index >= 0 else min_font_size
+
+# Binary search over candidates 0..count-1 (ascending size) for the largest one where
+# fits(i) is true, trying the largest first. Returns (index, probes); index -1 when nothing fits.
+def largest_fitting(count, fits):
+    if count <= 0:
+        return -1, 0
+    probes = 1
+    if fits(count - 1):
+        return count - 1, probes
+    lo, hi = 0, count - 2
+    best = -1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        probes += 1
+        if fits(mid):
+            best, lo = mid, mid + 1
+        else:
+            hi = mid - 1
+    return best, probes
 
 from PIL import Image, ImageDraw, ImageFont, ImageColor
 import textwrap
 import numpy as np
 
-def overlay_txt(ad, img, fill, font_path,
-                spacing_above_middle=-10, spacing_below_middle=30,
-                contact_spacing=5):
-    
-    fill = ImageColor.getrgb(fill)
+# One positioned line of text. section is the ad field it belongs to
+# (company_name, headline, text, call_to_action, hashtags or contact).
+TextRun = namedtuple("TextRun", ["section", "x", "y", "text", "font"])
+
+# Geometry of a rendered ad: everything overlay_txt needs except the colors.
+# scale is the factor applied to the middle block fonts (1.0 unless autofit shrank
+# them) and probes the number of middle block measurements it took to choose it.
+LayoutPlan = namedtuple("LayoutPlan", ["size", "font_path", "runs", "scale", "probes"], defaults=(1.0, 1))
+
+plan_cache = LRUCache(max_items=256)
+
+def ad_hash(ad):
+    return hashlib.md5(json.dumps(ad, sort_keys=True, default=str).encode()).hexdigest()
+
+# Layout depends only on the ad text, font and image size, so plans are cached and
+# a color/background change re-uses the same plan
+# With autofit, the middle block fonts are scaled down (in 1% steps, never below
+# min_scale) to the largest scale whose headline/body/CTA/hashtags fit between the
+# company name and the contact info.
+def compute_layout(ad, font_path, size, spacing_above_middle=-10, spacing_below_middle=30,
+                   contact_spacing=5, autofit=False, min_scale=0.5, max_scale=1.0):
+    size = tuple(size)
+    fit = (min_scale, max_scale) if autofit else None
+    key = (ad_hash(ad), font_path, size, spacing_above_middle, spacing_below_middle, contact_spacing, fit)
+    with span("layout"):
+        return plan_cache.get_or_create(key, lambda: _build_layout(
+            ad, font_path, size, spacing_above_middle, spacing_below_middle, contact_spacing, fit))
+
+def _build_layout(ad, font_path, size, spacing_above_middle, spacing_below_middle, contact_spacing, fit=None):
 
     # Extract ad fields
     company_name = ad.get("company_name", "")
@@ -109,96 +264,211 @@ def overlay_txt(ad, img, fill, font_path,
     email = ad.get("email", "")
     website = ad.get("website", "")
 
-    draw = ImageDraw.Draw(img)
-    img_width, img_height = img.size
+    img_width, img_height = size
 
     # Fonts
-    company_font = ImageFont.truetype(font_path, size=50)
-    headline_font = ImageFont.truetype(font_path, size=70)
-    body_font = ImageFont.truetype(font_path, size=45)  # slightly smaller
-    fixed_small_font = ImageFont.truetype(font_path, size=40)
-    contact_font = ImageFont.truetype(font_path, size=28)
+    company_font = get_font(font_path, OVERLAY_FONT_SIZES["company"])
+    contact_font = get_font(font_path, OVERLAY_FONT_SIZES["contact"])
 
     margin = 50
     bottom_margin = 40
     line_spacing = 10
     block_spacing = 25
 
-    def wrap_text(text, font, max_pixel_width):
-        words = text.split()
-        lines, line = [], ""
-        for word in words:
-            test_line = f"{line} {word}".strip()
-            if font.getlength(test_line) <= max_pixel_width:
-                line = test_line
-            else:
-                if line:
-                    lines.append(line)
-                line = word
-        if line:
-            lines.append(line)
-        return lines
-
-    def measure_block_height(text, font, max_pixel_width, spacing=line_spacing):
-        if not text:
-            return 0
-        lines = wrap_text(text, font, max_pixel_width)
-        return sum(font.getbbox(line)[3] - font.getbbox(line)[1] + spacing for line in lines) - spacing + block_spacing
-
-    def draw_text_block(text, font, max_pixel_width, y_offset,
-                        center_align=False, spacing=line_spacing):
-        if not text:
-            return y_offset
-        lines = wrap_text(text, font, max_pixel_width)
-        for line in lines:
-            line_width = font.getlength(line)
-            draw_x = (img_width - line_width) // 2 if center_align else margin
-            line_height = font.getbbox(line)[3] - font.getbbox(line)[1]
-            draw.text((draw_x, y_offset), line, font=font, fill=fill)
-            y_offset += line_height + spacing
-        return y_offset + block_spacing
-
     max_width = img_width - 2 * margin
+    runs = []
+
+    # Every block is wrapped and measured once
+    def layout(text, font, spacing=line_spacing):
+        return layout_block(text, font, max_width, spacing, block_spacing)
+
+    # Positions the lines of a block (same arithmetic as text_layout.draw_block)
+    def place(section, block, font, y_offset, center_align=False):
+        if not block.text:
+            return y_offset
+        for line in block.lines:
+            x = (img_width - line.width) // 2 if center_align else margin
+            runs.append(TextRun(section, x, y_offset, line.text, font))
+            y_offset += line.height + block.spacing
+        return y_offset + block.block_spacing
 
     # 1. Top - Company Name
-    y_top = draw_text_block(company_name, company_font, max_width, margin, center_align=False)
+    y_top = place("company_name", layout(company_name, company_font), company_font, margin)
 
     # 2. Bottom - Contact Info
     contact_blocks = [
-        ("We are located at " + location, contact_font),
-        ("Contact us at " + phone + " or " + email, contact_font),
-        ("Visit our website: " + website, contact_font),
+        (layout(text, contact_font, spacing=contact_spacing), contact_font)
+        for text in [
+            "We are located at " + location,
+            "Contact us at " + phone + " or " + email,
+            "Visit our website: " + website,
+        ]
     ]
-    contact_height = sum(
-        measure_block_height(text, font, max_width, spacing=contact_spacing)
-        for text, font in contact_blocks
-    )
+    contact_height = sum(block.height for block, font in contact_blocks)
 
     # 3. Middle Block - Headline + Body + CTA + Hashtags
-    middle_blocks = [
-        (headline, headline_font),
-        (text, body_font),
-        (call_to_action, fixed_small_font),
-        (hashtags, fixed_small_font),
-    ]
-    middle_height = sum(
-        measure_block_height(text, font, max_width)
-        for text, font in middle_blocks
-    )
+    measured = {}
+
+    def middle(scale):
+        if scale in measured:
+            return measured[scale]
+        headline_font = get_font(font_path, round(OVERLAY_FONT_SIZES["headline"] * scale))
+        body_font = get_font(font_path, round(OVERLAY_FONT_SIZES["body"] * scale))  # slightly smaller
+        fixed_small_font = get_font(font_path, round(OVERLAY_FONT_SIZES["small"] * scale))
+        blocks = [
+            ("headline", layout(headline, headline_font), headline_font),
+            ("text", layout(text, body_font), body_font),
+            ("call_to_action", layout(call_to_action, fixed_small_font), fixed_small_font),
+            ("hashtags", layout(hashtags, fixed_small_font), fixed_small_font),
+        ]
+        measured[scale] = blocks, sum(block.height for section, block, font in blocks)
+        return measured[scale]
+
+    free_height = img_height - y_top - contact_height - bottom_margin - \
+        spacing_above_middle - spacing_below_middle
+
+    scale, probes = 1.0, 1
+    if fit:
+        # Candidate scales in 1% steps, binary searched from the largest
+        steps = list(range(round(fit[0] * 100), round(fit[1] * 100) + 1))
+        index, probes = largest_fitting(len(steps), lambda i: middle(steps[i] / 100)[1] <= free_height)
+        scale = steps[max(index, 0)] / 100
+    middle_blocks, middle_height = middle(scale)
 
     # 4. Y Start for Middle Block
-    y_middle_start = y_top + spacing_above_middle + \
-        (img_height - y_top - contact_height - bottom_margin -
-         spacing_above_middle - spacing_below_middle - middle_height) // 2
+    y_middle_start = y_top + spacing_above_middle + (free_height - middle_height) // 2
 
-    # 5. Draw Middle
+    # 5. Middle
     y_middle = y_middle_start
-    for text, font in middle_blocks:
-        y_middle = draw_text_block(text, font, max_width, y_middle, center_align=True)
+    for section, block, font in middle_blocks:
+        y_middle = place(section, block, font, y_middle, center_align=True)
 
-    # 6. Draw Contact Info at Bottom
+    # 6. Contact Info at Bottom
     y_contact = img_height - contact_height - bottom_margin
-    for text, font in contact_blocks:
-        y_contact = draw_text_block(text, font, max_width, y_contact, center_align=False, spacing=contact_spacing)
+    for block, font in contact_blocks:
+        y_contact = place("contact", block, font, y_contact)
+
+    return LayoutPlan(size, font_path, runs, scale, probes)
+
+# Draw pass only: paints a precomputed plan onto the background (in place)
+def render(plan, background, fill):
+    fill = ImageColor.getrgb(fill) if isinstance(fill, str) else fill
+    with span("draw"):
+        draw = ImageDraw.Draw(background)
+        for run in plan.runs:
+            draw.text((run.x, run.y), run.text, font=run.font, fill=fill)
+    return background
+
+def overlay_txt(ad, img, fill, font_path,
+                spacing_above_middle=-10, spacing_below_middle=30,
+                contact_spacing=5, autofit=False):
+    plan = compute_layout(ad, font_path, img.size, spacing_above_middle, spacing_below_middle,
+                          contact_spacing, autofit=autofit)
+    return render(plan, img, fill)
+
+# A plan laid out at one size, redrawn at another: positions are scaled and every run
+# gets the font at the scaled size, so line breaks and autofit stay those of the
+# full-size render. Fonts don't scale exactly, so lines can come out a pixel or so
+# wider or narrower than the scaled original.
+def scale_plan(plan, size):
+    size = tuple(size)
+    factor = size[0] / plan.size[0]
+    runs = [
+        run._replace(x=run.x * factor, y=run.y * size[1] / plan.size[1],
+                     font=get_font(plan.font_path, max(1, round(run.font.size * factor))))
+        for run in plan.runs
+    ]
+    return plan._replace(size=size, runs=runs)
+
+# Width of the on-screen preview: half of a 1080 px ad. Scaled font sizes are rounded
+# to whole pixels (45 px body text is drawn at 22 px), so the preview is close to,
+# not exactly, the full render scaled down (see scale_plan).
+PREVIEW_WIDTH = 540
+
+def preview_size(size, width=PREVIEW_WIDTH):
+    width = min(width, size[0])
+    return width, round(size[1] * width / size[0])
+
+# Instant preview: the ad laid out at full_size (the cached plan of the full render)
+# and drawn with scaled fonts straight onto a background at the preview size, e.g.
+# get_bg(..., size=preview_size(full_size)). Returns a new image.
+def render_preview(ad, background, fill, font_path, full_size=(1080, 1080), autofit=False):
+    plan = compute_layout(ad, font_path, full_size, autofit=autofit)
+    key = ("preview", ad_hash(ad), font_path, tuple(full_size), autofit, background.size)
+    scaled = plan_cache.get_or_create(key, lambda: scale_plan(plan, background.size))
+    return render(scaled, background.copy(), fill)
+
+# Quick low-resolution render, e.g. for redrawing an ad while it is still streaming
+# in. Partial ads change with every token, so nothing here goes into the caches.
+def render_draft(ad, background, fill, font_path, width=360, autofit=False):
+    fit = (0.5, 1.0) if autofit else None
+    with span("draft_layout"):
+        plan = _build_layout(ad, font_path, background.size, -10, 30, 5, fit)
+        small = background.reduce(max(1, background.width // width))
+        plan = scale_plan(plan, small.size)
+    return render(plan, small, fill)
+
+# Transparent RGBA text layers, cached per (ad, font, color, size). ~4.7 MB each at 1080x1080.
+layer_cache = LRUCache(max_bytes=150 * 1024 * 1024, sizeof=image_nbytes)
+
+def render_text_layer(ad, font_path, fill, size=(1080, 1080), autofit=False):
+    fill = ImageColor.getrgb(fill)[:3] if isinstance(fill, str) else tuple(fill)[:3]
+    size = tuple(size)
+    plan = compute_layout(ad, font_path, size, autofit=autofit)
+    # Transparent pixels carry the text color so antialiased edges blend like direct drawing
+    return layer_cache.get_or_create(
+        (ad_hash(ad), font_path, fill, size, autofit),
+        lambda: render(plan, Image.new("RGBA", size, fill + (0,)), fill),
+    )
+
+# Puts a text layer over a background. Returns a new RGB image; neither input is modified.
+def composite_layer(background, layer):
+    if background.size != layer.size:
+        raise ValueError(f"Background size {background.size} does not match text layer size {layer.size}")
+    with span("composite"):
+        return Image.alpha_composite(background.convert("RGBA"), layer).convert("RGB")
+
+def overlay_txt_layer(ad, background, fill, font_path, autofit=False):
+    return composite_layer(background, render_text_layer(ad, font_path, fill, background.size, autofit))
+
+# The same ad over several backgrounds with a single text rasterization
+def render_previews(ad, backgrounds, fill, font_path, autofit=False):
+    return [overlay_txt_layer(ad, background, fill, font_path, autofit) for background in backgrounds]
+
+
+# Feed and story sizes per platform, as (name, (width, height))
+PLATFORM_FORMATS = {
+    "Instagram": [("square", (1080, 1080)), ("portrait", (1080, 1350)), ("story", (1080, 1920))],
+    "Facebook": [("square", (1080, 1080)), ("landscape", (1200, 628)), ("story", (1080, 1920))],
+    "Twitter": [("landscape", (1600, 900)), ("square", (1080, 1080))],
+    "LinkedIn": [("square", (1080, 1080)), ("landscape", (1200, 627)), ("portrait", (1080, 1350))],
+}
+
+def platform_formats(platform):
+    return PLATFORM_FORMATS.get(platform, [("square", (1080, 1080))])
+
+# fn(item) for every item on a thread pool, results in order. Fonts, word widths and
+# wrapped blocks are shared by the threads through the module caches (FreeType calls
+# hold the GIL; resizing, compositing and encoding release it). Each task runs in a
+# copy of the caller's context so its spans land in the caller's trace.
+def map_concurrently(fn, items, max_workers=None):
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=max_workers or len(items)) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+        return [future.result() for future in futures]
+
+Rendition = namedtuple("Rendition", ["name", "size", "image"])
+
+# The same ad in several formats at once. background(size) returns the background at
+# that native size (e.g. lambda size: get_bg("Gradient", colors, direction, size)),
+# so nothing is stretched or cropped from another format. Autofit is on by default
+# since wide formats have much less height for the middle block.
+def render_formats(ad, background, fill, font_path, formats, autofit=True, max_workers=None):
+    def render_one(fmt):
+        name, size = fmt
+        size = tuple(size)
+        return Rendition(name, size, overlay_txt_layer(ad, background(size), fill, font_path, autofit))
+    return map_concurrently(render_one, formats, max_workers)
 
-    return img
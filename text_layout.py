@@ -0,0 +1,95 @@
+from collections import namedtuple
+import weakref
+
+from cache import LRUCache
+
+
+# A wrapped line with its exact pixel width (font.getlength) and ink height (getbbox)
+Line = namedtuple("Line", ["text", "width", "height"])
+
+# A wrapped, measured block of text. height follows the original measure_block_height:
+# line heights plus spacing between lines plus block_spacing, and 0 for empty text.
+TextBlock = namedtuple("TextBlock", ["text", "lines", "height", "spacing", "block_spacing"])
+
+
+# Per-font word width cache. Fonts come from the shared registry in image_gen,
+# so the cache lives as long as the font does.
+class FontMetrics:
+
+    def __init__(self, font):
+        self.font = font
+        self.space = font.getlength(" ")
+        # Summed word widths can drift from the real line width by the kerning
+        # around spaces; lines this close to the limit are measured exactly
+        self.slack = max(getattr(font, "size", 0) * 0.25, 1)
+        self.words = {}
+
+    def width(self, word):
+        width = self.words.get(word)
+        if width is None:
+            width = self.words[word] = self.font.getlength(word)
+        return width
+
+
+_metrics = weakref.WeakKeyDictionary()
+
+def font_metrics(font):
+    metrics = _metrics.get(font)
+    if metrics is None:
+        metrics = _metrics[font] = FontMetrics(font)
+    return metrics
+
+
+# Greedy word wrap with the same line breaks as the old wrap_text_by_width, but
+# built from cumulative cached word widths instead of re-measuring the growing line
+def wrap_lines(text, font, max_pixel_width):
+    metrics = font_metrics(font)
+    lines, words, width = [], [], 0.0
+    for word in text.split():
+        word_width = metrics.width(word)
+        if not words:
+            words, width = [word], word_width
+            continue
+        test_width = width + metrics.space + word_width
+        if abs(test_width - max_pixel_width) <= metrics.slack:
+            test_width = font.getlength(" ".join(words + [word]))
+        if test_width <= max_pixel_width:
+            words.append(word)
+            width = test_width
+        else:
+            lines.append(" ".join(words))
+            words, width = [word], word_width
+    if words:
+        lines.append(" ".join(words))
+    return lines
+
+def measure_line(text, font):
+    left, top, right, bottom = font.getbbox(text)
+    return Line(text, font.getlength(text), bottom - top)
+
+# Wrapped blocks are immutable, so identical blocks (the company name and contact
+# lines shared by every variant/restyle of an ad) are laid out once
+block_cache = LRUCache(max_items=4096)
+
+def layout_block(text, font, max_pixel_width, spacing=15, block_spacing=30):
+    if not text:
+        return TextBlock(text, [], 0, spacing, block_spacing)
+    return block_cache.get_or_create(
+        (text, font, max_pixel_width, spacing, block_spacing),
+        lambda: _layout_block(text, font, max_pixel_width, spacing, block_spacing),
+    )
+
+def _layout_block(text, font, max_pixel_width, spacing, block_spacing):
+    lines = [measure_line(line, font) for line in wrap_lines(text, font, max_pixel_width)]
+    height = sum(line.height + spacing for line in lines) - spacing + block_spacing
+    return TextBlock(text, lines, height, spacing, block_spacing)
+
+# Draws a block produced by layout_block and returns the y offset below it
+def draw_block(draw, block, font, y_offset, img_width, margin=50, fill=(0, 0, 0), center_align=False):
+    if not block.text:
+        return y_offset
+    for line in block.lines:
+        x = (img_width - line.width) // 2 if center_align else margin
+        draw.text((x, y_offset), line.text, font=font, fill=fill)
+        y_offset += line.height + block.spacing
+    return y_offset + block.block_spacing
@@ -0,0 +1,230 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger("adcraft.trace")
+
+_current = contextvars.ContextVar("adcraft_trace", default=None)
+
+
+# Timings of one request: (stage, seconds) spans in the order they finished. Spans
+# can nest (a font load inside a layout), so stage times may add up to more than
+# the total.
+class Trace:
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.total = None
+
+    def add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+
+    def finish(self):
+        if self.total is None:
+            self.total = time.perf_counter() - self._start
+        return self
+
+    # Seconds per stage, summed over repeated spans, in first-seen order
+    def breakdown(self):
+        stages = {}
+        for stage, seconds in self.spans:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        return stages
+
+    def to_dict(self):
+        return {
+            "trace": self.name,
+            "started": self.started,
+            "total_ms": round((self.total or 0.0) * 1000, 3),
+            "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self.breakdown().items()},
+        }
+
+
+# Times the block into the active trace; does nothing (beyond a context variable
+# lookup) when no trace is active
+class span:
+    __slots__ = ("stage", "trace", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.trace = _current.get()
+        if self.trace is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.stage, time.perf_counter() - self.start)
+        return False
+
+# For stages that don't fit a with block (e.g. time to the first streamed chunk)
+def add_span(stage, seconds):
+    current = _current.get()
+    if current is not None:
+        current.add(stage, seconds)
+
+def current_trace():
+    return _current.get()
+
+# Passes a stream through, adding the time spent producing its items as `stage`
+# (the consumer's time between items is not counted) and, if given, the time to
+# the first item as `first_stage`
+def timed_iter(iterable, stage, first_stage=None):
+    iterator = iter(iterable)
+    start = time.perf_counter()
+    producing = 0.0
+    first = True
+    while True:
+        before = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            producing += time.perf_counter() - before
+        if first and first_stage:
+            add_span(first_stage, time.perf_counter() - start)
+        first = False
+        yield item
+    add_span(stage, producing)
+
+
+# Starts a trace for the current thread/task. Unlike the trace() context manager it
+# doesn't need to wrap the work in a block, e.g. a Streamlit script run that can
+# end in many places; a trace that is never ended is simply not recorded.
+def begin_trace(name):
+    current = Trace(name)
+    _current.set(current)
+    return current
+
+def end_trace(current, recorder=None):
+    if _current.get() is current:
+        _current.set(None)
+    (recorder or default_recorder).record(current.finish())
+    return current
+
+# Traces the block, or if a trace is already active (e.g. generate_ad called from
+# the app's request trace), adds its spans to that one
+@contextmanager
+def trace(name, recorder=None):
+    current = _current.get()
+    if current is not None:
+        yield current
+        return
+    current = Trace(name)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        (recorder or default_recorder).record(current.finish())
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+# Recent finished traces of the process, summarized per (trace, stage). Each trace
+# is also logged as one JSON line on the "adcraft.trace" logger at INFO.
+class TraceRecorder:
+
+    def __init__(self, max_traces=500):
+        self._traces = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def record(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(trace.to_dict()))
+
+    def traces(self):
+        with self._lock:
+            return list(self._traces)
+
+    # {trace: {stage: {count, p50_ms, p95_ms}}}, with the whole trace as stage "total".
+    # A stage's percentiles are over the traces that ran it.
+    def stage_stats(self):
+        samples = {}
+        for current in self.traces():
+            stages = samples.setdefault(current.name, {"total": []})
+            stages["total"].append(current.total)
+            for stage, seconds in current.breakdown().items():
+                stages.setdefault(stage, []).append(seconds)
+        return {
+            name: {
+                stage: {
+                    "count": len(values),
+                    "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+                    "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+                }
+                for stage, values in stages.items()
+            }
+            for name, stages in samples.items()
+        }
+
+    # Prometheus text exposition format: a summary per (trace, stage) over the recent traces
+    def prometheus_text(self):
+        samples = {}
+        for current in self.traces():
+            samples.setdefault((current.name, "total"), []).append(current.total)
+            for stage, seconds in current.breakdown().items():
+                samples.setdefault((current.name, stage), []).append(seconds)
+        lines = [
+            "# HELP adcraft_stage_seconds Time spent per stage over recent requests.",
+            "# TYPE adcraft_stage_seconds summary",
+        ]
+        for (name, stage), values in sorted(samples.items()):
+            labels = f'trace="{name}",stage="{stage}"'
+            for q in (0.5, 0.95):
+                lines.append(f'adcraft_stage_seconds{{{labels},quantile="{q}"}} {percentile(values, q):.6f}')
+            lines.append(f"adcraft_stage_seconds_sum{{{labels}}} {sum(values):.6f}")
+            lines.append(f"adcraft_stage_seconds_count{{{labels}}} {len(values)}")
+        return "\n".join(lines) + "\n"
+
+
+default_recorder = TraceRecorder()
+
+
+_server = None
+_server_lock = threading.Lock()
+
+# Serves default_recorder.prometheus_text() at http://<host>:<port>/metrics from a
+# daemon thread. Safe to call on every Streamlit rerun: only the first call starts it.
+def serve_metrics(port, host="0.0.0.0", recorder=None):
+    global _server
+    recorder = recorder or default_recorder
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = recorder.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server